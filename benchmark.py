@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Join Storm Benchmark
+Runs the bot against a local fake Bot API server and measures the join pipeline
+
+Usage:
+    python benchmark.py --joins 5000 --chats 50
+    python benchmark.py --mode webhook --latency 40 --retry-after-rate 0.01 --forbidden-rate 0.2
+    RATE_LIMIT_GLOBAL=1000 python benchmark.py --fail-under 200
+
+The bot runs as a separate process (python telegram_auto_accept_bot.py) with
+BOT_API_URL pointed at the fake server and a throwaway database. Any tuning
+variables set in your environment (RATE_LIMIT_*, DM_WORKERS, ...) are passed
+through. Reports approvals/s, approve-to-DM latency and the database write
+rate; --fail-under makes the run fail when approvals/s drop below a floor.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from tornado import httpserver, web
+
+from webhook_harness import make_join_storm, percentile, post_updates
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telegram_auto_accept_bot.py')
+BOT_TOKEN = "123456:benchmark"
+
+
+class FakeBotAPI:
+    """In-memory stand-in for the Bot API that records what the bot does"""
+
+    def __init__(self, updates, latency, retry_after_rate, forbidden_rate):
+        self.pending = list(updates)
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.forbidden_rate = forbidden_rate
+        self.approved_at = {}  # user_id -> time the approval was answered
+        self.welcomed_at = {}  # user_id -> time the welcome message was answered
+        self.counts = {'approve': 0, 'send': 0, 'retry_after': 0, 'forbidden': 0, 'other': 0}
+        self.ready = asyncio.Event()
+
+    def is_forbidden(self, chat_id):
+        # Decided per user, so retries see the same answer
+        return random.Random(chat_id).random() < self.forbidden_rate
+
+    async def call(self, method, data):
+        """Answer one Bot API method; returns (HTTP status, response body)"""
+        if method == 'getMe':
+            return 200, {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if method in ('deleteWebhook', 'setWebhook'):
+            if method == 'setWebhook':
+                self.ready.set()
+            return 200, True
+        if method == 'getUpdates':
+            self.ready.set()
+            offset = int(data.get('offset') or 0)
+            self.pending = [update for update in self.pending if update['update_id'] >= offset]
+            if not self.pending:
+                await asyncio.sleep(min(float(data.get('timeout') or 0), 0.5))
+            return 200, self.pending[:int(data.get('limit') or 100)]
+
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if method == 'approveChatJoinRequest':
+            self.counts['approve'] += 1
+            self.approved_at[int(data['user_id'])] = time.monotonic()
+            return 200, True
+        if method.startswith('send'):
+            chat_id = int(data['chat_id'])
+            if random.random() < self.retry_after_rate:
+                self.counts['retry_after'] += 1
+                return 429, {'error_code': 429, 'description': "Too Many Requests: retry after 1",
+                             'parameters': {'retry_after': 1}}
+            if self.is_forbidden(chat_id):
+                self.counts['forbidden'] += 1
+                return 403, {'error_code': 403, 'description': "Forbidden: bot was blocked by the user"}
+            self.counts['send'] += 1
+            # The welcome is always the last message of a join's DMs
+            if method == 'sendMessage' and str(data.get('text', '')).startswith('Hello'):
+                self.welcomed_at[chat_id] = time.monotonic()
+            return 200, {'message_id': self.counts['send'], 'date': int(time.time()),
+                         'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+        self.counts['other'] += 1
+        return 200, True
+
+
+class BotAPIHandler(web.RequestHandler):
+    """POST /bot<token>/<method>"""
+
+    def initialize(self, api):
+        self.api = api
+
+    async def post(self, token, method):
+        body = self.request.body or b'{}'
+        if 'json' in self.request.headers.get('Content-Type', ''):
+            data = json.loads(body)
+        else:
+            data = {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+        status, result = await self.api.call(method, data)
+        self.set_status(status)
+        if status == 200:
+            self.write({'ok': True, 'result': result})
+        else:
+            self.write(dict(result, ok=False))
+
+
+def bot_environment(args, port, db_path):
+    """Environment for the bot process; tuning variables from the caller pass through"""
+    env = dict(os.environ)
+    env.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'BOT_USERNAME': 'benchmark_bot',
+        'ADMIN_ID': '1',
+        'BOT_API_URL': f"http://127.0.0.1:{port}/bot",
+        'DB_PATH': db_path,
+        'BOT_MODE': args.mode,
+        'BACKLOG_MODE': '1' if args.backlog else '0',
+        'SHARDS': str(args.shards),
+        'PYTHONUNBUFFERED': '1',
+    })
+    env.pop('STORE_URL', None)
+    if args.mode == 'webhook':
+        env.update({
+            'WEBHOOK_URL': f"http://127.0.0.1:{args.webhook_port}",
+            'WEBHOOK_LISTEN': '127.0.0.1',
+            'WEBHOOK_PORT': str(args.webhook_port),
+            'WEBHOOK_SECRET': 'benchmark',
+        })
+    return env
+
+
+def count_db_rows(db_path):
+    """Join rows written so far, or 0 before the schema exists"""
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT value FROM stats_counters WHERE name = 'total_joins'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+    return row[0] if row else 0
+
+
+async def wait_for(condition, timeout, interval=0.1):
+    """Poll until condition() is true or the timeout passes; returns the final result"""
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(interval)
+    return condition()
+
+
+async def run_benchmark(args):
+    updates = list(make_join_storm(args.joins, args.chats))
+    api = FakeBotAPI(
+        updates if args.mode == 'polling' else [],
+        args.latency / 1000,
+        args.retry_after_rate,
+        args.forbidden_rate,
+    )
+    server = httpserver.HTTPServer(web.Application(
+        [(r'/bot([^/]+)/(\w+)', BotAPIHandler, {'api': api})],
+        log_function=lambda handler: None,  # injected errors would flood the output
+    ))
+    server.listen(args.port, '127.0.0.1')
+
+    workdir = tempfile.mkdtemp(prefix='bot-benchmark-')
+    db_path = os.path.join(workdir, 'benchmark.db')
+    log_path = os.path.join(workdir, 'bot.log')
+    with open(log_path, 'w') as log:
+        bot = await asyncio.create_subprocess_exec(
+            sys.executable, BOT_SCRIPT,
+            env=bot_environment(args, args.port, db_path),
+            stdout=log, stderr=asyncio.subprocess.STDOUT,
+        )
+
+    try:
+        await asyncio.wait_for(api.ready.wait(), 30)
+    except asyncio.TimeoutError:
+        bot.kill()
+        raise SystemExit(f"Bot did not start; see {log_path}")
+
+    started = time.monotonic()
+    if args.mode == 'webhook':
+        await asyncio.sleep(0.5)  # setWebhook is answered just before the server starts listening
+        statuses, _ = await post_updates(
+            f"http://127.0.0.1:{args.webhook_port}/{os.environ.get('WEBHOOK_PATH', 'telegram')}",
+            'benchmark', updates, args.concurrency
+        )
+        print(f"Webhook responses: {statuses}")
+
+    # Sample the database while the storm is processed
+    samples = []
+    expected_dms = sum(1 for update in updates if not api.is_forbidden(update['chat_join_request']['from']['id']))
+
+    def finished():
+        samples.append((time.monotonic(), count_db_rows(db_path)))
+        return api.counts['approve'] >= args.joins and len(api.welcomed_at) >= expected_dms and samples[-1][1] >= args.joins
+
+    complete = await wait_for(finished, args.timeout, interval=0.5)
+    elapsed = time.monotonic() - started
+
+    bot.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(bot.wait(), 30)
+    except asyncio.TimeoutError:
+        bot.kill()
+    server.stop()
+    await asyncio.sleep(1)  # let the last long poll finish
+
+    report(args, api, samples, elapsed, complete, expected_dms, log_path)
+    approved = len(api.approved_at)
+    return approved / elapsed if elapsed else 0.0
+
+
+def report(args, api, samples, elapsed, complete, expected_dms, log_path):
+    """Print the results of a run"""
+    approve_times = sorted(api.approved_at.values())
+    approve_window = approve_times[-1] - approve_times[0] if len(approve_times) > 1 else elapsed
+    latencies = [
+        api.welcomed_at[user_id] - approved_at
+        for user_id, approved_at in api.approved_at.items()
+        if user_id in api.welcomed_at
+    ]
+    rates = [
+        (rows - previous_rows) / (at - previous_at)
+        for (previous_at, previous_rows), (at, rows) in zip(samples, samples[1:])
+        if at > previous_at
+    ]
+    written = samples[-1][1] if samples else 0
+
+    print(f"Join storm: {args.joins} requests over {args.chats} chats ({args.mode}, {args.shards} shard(s))")
+    print(f"Completed: {'yes' if complete else f'NO (timed out after {args.timeout:.0f}s)'} in {elapsed:.2f}s")
+    print(f"Approvals: {len(api.approved_at)} ({len(api.approved_at) / approve_window if approve_window else 0:.0f}/s)")
+    print(f"DMs: {api.counts['send']} sent, {len(api.welcomed_at)}/{expected_dms} users welcomed, "
+          f"{api.counts['forbidden']} Forbidden, {api.counts['retry_after']} RetryAfter injected")
+    print(f"Approve to DM latency p50: {percentile(latencies, 0.5) * 1000:.0f}ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.0f}ms")
+    print(f"DB writes: {written} join rows, avg {written / elapsed if elapsed else 0:.0f} rows/s, "
+          f"peak {max(rates, default=0):.0f} rows/s")
+    print(f"Bot log: {log_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the join pipeline against a fake Bot API")
+    parser.add_argument('--joins', type=int, default=2000, help="Number of join requests")
+    parser.add_argument('--chats', type=int, default=20, help="Spread join requests over N chats")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling', help="How updates reach the bot")
+    parser.add_argument('--shards', type=int, default=1, help="SHARDS for the bot process")
+    parser.add_argument('--backlog', action='store_true', help="Let the bot drain the storm as a startup backlog")
+    parser.add_argument('--latency', type=float, default=20, help="Average fake Bot API latency in ms")
+    parser.add_argument('--retry-after-rate', type=float, default=0.0, help="Share of sends answered with RetryAfter")
+    parser.add_argument('--forbidden-rate', type=float, default=0.0, help="Share of users who blocked the bot")
+    parser.add_argument('--port', type=int, default=8081, help="Port of the fake Bot API")
+    parser.add_argument('--webhook-port', type=int, default=8444, help="Port the bot listens on in webhook mode")
+    parser.add_argument('--concurrency', type=int, default=50, help="Parallel webhook posts")
+    parser.add_argument('--timeout', type=float, default=300, help="Give up after N seconds")
+    parser.add_argument('--fail-under', type=float, default=0, help="Exit with an error below N approvals/s")
+    args = parser.parse_args()
+
+    rate = asyncio.run(run_benchmark(args))
+    if args.fail_under and rate < args.fail_under:
+        print(f"FAIL: {rate:.0f} approvals/s is below {args.fail_under:.0f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
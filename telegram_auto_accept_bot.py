@@ -4,21 +4,53 @@ Telegram Auto-Accept Bot with Admin Panel
 Automatically accepts join requests with customizable ads and statistics
 """
 
+import asyncio
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import shutil
+import signal
 import sqlite3
-from datetime import datetime, timedelta
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from telegram import Bot, ChatJoinRequest, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     ChatJoinRequestHandler,
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
+    PersistenceInput,
+    Updater,
     ContextTypes,
     filters,
 )
+from tornado import httpserver, web
 
 # Enable logging
 logging.basicConfig(
@@ -31,6 +63,84 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 BOT_USERNAME = os.environ.get("BOT_USERNAME")
 ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))  # Your Telegram user ID
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")  # e.g. a local Bot API server
+DB_PATH = os.environ.get("DB_PATH", "bot_data.db")
+
+# Sharding and shared storage
+# SHARDS > 1 runs one coordinator that receives updates and owns the database,
+# plus SHARDS worker processes that handle updates partitioned by chat_id.
+SHARDS = int(os.environ.get("SHARDS", "1"))
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", "10000"))
+STORE_URL = os.environ.get("STORE_URL", "")  # e.g. tcp://127.0.0.1:8765; empty = local SQLite
+STORE_LISTEN = os.environ.get("STORE_LISTEN", "127.0.0.1:8765")
+STORE_SECRET = os.environ.get("STORE_SECRET") or hashlib.sha256(f"store:{BOT_TOKEN}".encode()).hexdigest()
+AD_REFRESH_INTERVAL = float(os.environ.get("AD_REFRESH_INTERVAL", "5"))  # seconds, remote store only
+
+# Compaction of raw event rows into rollups
+RAW_RETENTION_DAYS = int(os.environ.get("RAW_RETENTION_DAYS", "30"))  # 0 = keep raw rows forever
+HOURLY_RETENTION_DAYS = int(os.environ.get("HOURLY_RETENTION_DAYS", "90"))  # 0 = keep hourly rollups forever
+COMPACTION_INTERVAL = int(os.environ.get("COMPACTION_INTERVAL", "3600"))  # seconds
+COMPACTION_CHUNK = int(os.environ.get("COMPACTION_CHUNK", "5000"))  # rows per transaction
+VACUUM_PAGES = int(os.environ.get("VACUUM_PAGES", "2000"))  # pages freed per run
+VACUUM_ON_START = os.environ.get("VACUUM_ON_START", "0") == "1"  # one full VACUUM to switch an old database to incremental
+
+# Update processing: CONCURRENT_UPDATES <= 1 keeps the old sequential behaviour
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+JOIN_CONCURRENCY_PER_CHAT = int(os.environ.get("JOIN_CONCURRENCY_PER_CHAT", "0"))  # 0 = global limit only
+
+# Outbound private-message queue
+DM_WORKERS = int(os.environ.get("DM_WORKERS", "8"))
+DM_MAX_ATTEMPTS = int(os.environ.get("DM_MAX_ATTEMPTS", "5"))
+DM_QUEUE_SIZE = int(os.environ.get("DM_QUEUE_SIZE", "1000"))  # jobs held in memory; the rest wait in the dm_outbox table
+DM_DRAIN_TIMEOUT = float(os.environ.get("DM_DRAIN_TIMEOUT", "10"))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", "600"))  # a claimed job not finished by then is sent again
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "5"))  # seconds between outbox checks when idle
+OUTBOX_KEEP_SECONDS = int(os.environ.get("OUTBOX_KEEP_SECONDS", "86400"))  # finished jobs still match idempotency keys this long
+
+# Lower number = sent first
+PRIORITY_WELCOME = 10
+PRIORITY_BACKLOG = 20  # welcomes for requests approved from the startup backlog
+
+# Startup backlog: approve join requests that queued up while the bot was down
+BACKLOG_MODE = os.environ.get("BACKLOG_MODE", "1") == "1"
+BACKLOG_CONCURRENCY = int(os.environ.get("BACKLOG_CONCURRENCY", "16"))
+BACKLOG_PROGRESS_INTERVAL = float(os.environ.get("BACKLOG_PROGRESS_INTERVAL", "10"))  # seconds between admin updates
+BACKLOG_PAGE_SIZE = 100  # stored join requests approved per page; a crash repeats at most one page
+
+# /broadcast: send the current ad to everyone who ever joined
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "20"))  # messages/s; keep below RATE_LIMIT_GLOBAL so welcomes still go out
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "16"))
+BROADCAST_BATCH = int(os.environ.get("BROADCAST_BATCH", "500"))  # users read and checkpointed at a time
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "10"))  # seconds between admin updates
+
+# /export: gzipped CSV of join/click history, sent to the admin as documents
+EXPORT_CHUNK = int(os.environ.get("EXPORT_CHUNK", "5000"))  # row ids scanned per database call
+EXPORT_PART_MB = float(os.environ.get("EXPORT_PART_MB", "45"))  # Telegram accepts uploads up to 50 MB
+EXPORT_UPLOAD_TIMEOUT = float(os.environ.get("EXPORT_UPLOAD_TIMEOUT", "300"))
+
+# Repeat joiners: approve again but don't re-send the welcome within this window
+WELCOME_DEDUP_SECONDS = int(os.environ.get("WELCOME_DEDUP_SECONDS", "86400"))  # 0 = always send
+WELCOME_DEDUP_SIZE = int(os.environ.get("WELCOME_DEDUP_SIZE", "100000"))  # users kept in memory
+WELCOME_DEDUP_DISK = os.environ.get("WELCOME_DEDUP_DISK", "0") == "1"  # also remember them in the database
+
+# Frequency-capped campaigns are re-drawn this many times before falling back to the default ad
+CAMPAIGN_PICK_ATTEMPTS = 3
+
+# Rate limits (Telegram allows ~30 msg/s overall, ~1 msg/s per user, 20 msg/min per group)
+RATE_LIMIT_GLOBAL = float(os.environ.get("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_PER_CHAT = float(os.environ.get("RATE_LIMIT_PER_CHAT", "1"))
+RATE_LIMIT_PER_CHAT_BURST = float(os.environ.get("RATE_LIMIT_PER_CHAT_BURST", "3"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.environ.get("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", "3"))
+
+# Write-behind journal for join/click events
+JOURNAL_BATCH_SIZE = int(os.environ.get("JOURNAL_BATCH_SIZE", "500"))
+JOURNAL_FLUSH_MS = int(os.environ.get("JOURNAL_FLUSH_MS", "200"))
+JOURNAL_MAX_PENDING = int(os.environ.get("JOURNAL_MAX_PENDING", "20000"))
+JOURNAL_MAX_RETRIES = int(os.environ.get("JOURNAL_MAX_RETRIES", "8"))  # then the batch is written row by row
+
+# /setad progress survives restarts; changes are written at most once per interval
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", "30"))  # seconds
 
 # Validate configuration
 if not BOT_TOKEN:
@@ -40,17 +150,249 @@ if not BOT_USERNAME:
 if not ADMIN_ID:
     raise ValueError("ADMIN_ID environment variable is required!")
 
+# Update delivery: "polling" (default) or "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling").lower()
+_railway_domain = os.environ.get("RAILWAY_PUBLIC_DOMAIN")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", f"https://{_railway_domain}" if _railway_domain else "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+# Telegram echoes this in the X-Telegram-Bot-Api-Secret-Token header; defaults to a value derived from the token
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Built-in HTTP server for tracked ad links. CLICK_BASE_URL is its public
+# address (e.g. https://clicks.example.com); leave it empty to keep plain links.
+CLICK_BASE_URL = os.environ.get("CLICK_BASE_URL", "").rstrip("/")
+CLICK_SECRET = os.environ.get("CLICK_SECRET") or hashlib.sha256(f"click:{BOT_TOKEN}".encode()).hexdigest()
+HTTP_LISTEN = os.environ.get("HTTP_LISTEN", "0.0.0.0")
+# In polling mode Railway's PORT is free for this server; webhook mode already uses it
+HTTP_PORT = int(os.environ.get("HTTP_PORT", os.environ.get("PORT", "8080") if BOT_MODE == "polling" else "8080"))
+
+# Prometheus metrics at http://HTTP_LISTEN:HTTP_PORT/metrics (shard N: HTTP_PORT + 1 + N)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))  # seconds between event-loop lag probes
+
+# Handler timing and /profile
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", "1"))  # handler calls slower than this are logged and kept
+SLOW_CALLS_KEPT = int(os.environ.get("SLOW_CALLS_KEPT", "50"))
+SLOW_LOG_INTERVAL = float(os.environ.get("SLOW_LOG_INTERVAL", "60"))  # at most one slow-handler warning per interval
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds between stack samples
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE must be either 'polling' or 'webhook'!")
+if BOT_MODE == "webhook" and not WEBHOOK_URL:
+    raise ValueError("WEBHOOK_URL environment variable is required in webhook mode!")
+if BOT_MODE == "webhook" and CLICK_BASE_URL and HTTP_PORT == WEBHOOK_PORT:
+    raise ValueError("HTTP_PORT must differ from WEBHOOK_PORT when click tracking is on in webhook mode!")
+
 # Conversation states
 WAITING_FOR_PHOTO, WAITING_FOR_TEXT, WAITING_FOR_BUTTON, WAITING_FOR_MORE_BUTTONS = range(4)
 
-# Database setup
-def init_db():
-    """Initialize the database"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    
-    # Table for ad configuration
-    c.execute('''
+# Message templates and keyboards
+# Built once at startup; keyboards are immutable so every handler shares them.
+WELCOME_TEXT_PREFIX = "Hello🎈 "
+WELCOME_TEXT_SUFFIX = (
+    "!\n\n"
+    "I Accept Join Requests Automatically\n"
+    "Just ✨ Add Me To Your Channel ➕\n"
+    "Click /start To Know More ⭐⭐"
+)
+
+def welcome_text(first_name):
+    """Fill the user's name into the welcome template"""
+    return WELCOME_TEXT_PREFIX + (first_name or "User") + WELCOME_TEXT_SUFFIX
+
+ADD_TO_GROUP_BUTTON = InlineKeyboardButton(
+    "Add me to your group",
+    url=f"https://t.me/{BOT_USERNAME}?startgroup=s&admin=invite_users"
+)
+ADD_TO_CHANNEL_BUTTON = InlineKeyboardButton(
+    "Add me to your channel",
+    url=f"https://t.me/{BOT_USERNAME}?startchannel=s&admin=invite_users"
+)
+START_KEYBOARD = InlineKeyboardMarkup([
+    [ADD_TO_GROUP_BUTTON],
+    [ADD_TO_CHANNEL_BUTTON],
+])
+ADMIN_START_KEYBOARD = InlineKeyboardMarkup([
+    [ADD_TO_GROUP_BUTTON],
+    [ADD_TO_CHANNEL_BUTTON],
+    [InlineKeyboardButton("⚙️ Admin Panel", callback_data="admin_panel")],
+])
+WELCOME_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔴 Click Here To Start 🔴", url=f"https://t.me/{BOT_USERNAME}?start=start")],
+    [ADD_TO_GROUP_BUTTON],
+    [ADD_TO_CHANNEL_BUTTON],
+])
+ADMIN_PANEL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Setup Ad", callback_data="setup_ad")],
+    [InlineKeyboardButton("👁️ View Ad", callback_data="view_ad")],
+    [InlineKeyboardButton("🗑️ Clear Ad", callback_data="clear_ad")],
+    [InlineKeyboardButton("📊 Statistics", callback_data="show_stats")],
+    [InlineKeyboardButton("🔙 Back", callback_data="back_to_start")],
+])
+
+# Metrics
+# Minimal Prometheus text-format instruments; render_metrics() serves them
+# on /metrics. Label values are passed positionally in the order of ``labels``.
+METRICS = []
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class CounterMetric:
+    """Monotonic counter, optionally split by labels"""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class GaugeMetric:
+    """Value read from a callback at scrape time"""
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+        METRICS.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+class HistogramMetric:
+    """Cumulative-bucket histogram of durations in seconds"""
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = format_labels(self.labels + ('le',), label_values + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def format_labels(names, values):
+    """Render {name="value",...} for a series"""
+    if not names:
+        return ""
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def render_metrics():
+    """Every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+JOIN_APPROVALS = CounterMetric('bot_join_approvals_total', "Join requests handled, by result", ('result',))
+APPROVE_SECONDS = HistogramMetric('bot_join_approve_seconds', "Latency of the approveChatJoinRequest call")
+DM_MESSAGES_SENT = CounterMetric('bot_dm_messages_sent_total', "Private messages sent")
+DM_JOBS = CounterMetric('bot_dm_jobs_total', "Welcome DM jobs by outcome (completed, forbidden, bad_request, retry_after, network_error, gave_up)", ('result',))
+DM_SECONDS = HistogramMetric('bot_dm_latency_seconds', "Time from approving a join until its last DM was sent")
+DB_CALL_SECONDS = HistogramMetric('bot_db_call_seconds', "Storage call latency including time queued for the database thread", ('function',))
+RETRY_AFTER = CounterMetric('bot_retry_after_total', "Flood-control RetryAfter answers from Telegram, by endpoint", ('endpoint',))
+HANDLER_SECONDS = HistogramMetric('bot_handler_seconds', "Run time of each update handler callback", ('handler',))
+SLOW_HANDLER_CALLS = CounterMetric('bot_slow_handler_calls_total', "Handler calls slower than SLOW_HANDLER_SECONDS", ('handler',))
+BROADCAST_MESSAGES = CounterMetric('bot_broadcast_messages_total', "Broadcast messages by result (sent, blocked, failed)", ('result',))
+LOOP_LAG_SECONDS = HistogramMetric('bot_event_loop_lag_seconds', "How much later than requested the event loop woke a sleeping task")
+
+async def monitor_event_loop():
+    """Probe event-loop lag: sleep a fixed interval and record how late we wake up"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+# Storage layer
+# Every database call runs on DB_EXECUTOR's single worker thread against one
+# long-lived connection, so SQLite I/O and fsyncs never stall the event loop.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+DB_PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL",  # first, so a new database file is created with it
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+_db_conn = None
+
+def get_db():
+    """Get the shared database connection, opening it on first use"""
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        _db_conn = conn
+    return _db_conn
+
+def close_db():
+    """Close the shared database connection"""
+    global _db_conn
+    if _db_conn is not None:
+        _db_conn.close()
+        _db_conn = None
+
+STORAGE_FUNCTIONS = {}
+
+def storage_function(func):
+    """Register a database helper so it can also be called through a remote store"""
+    STORAGE_FUNCTIONS[func.__name__] = func
+    return func
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper on the configured store"""
+    started = time.perf_counter()
+    try:
+        return await STORE.call(func, *args, **kwargs)
+    finally:
+        DB_CALL_SECONDS.observe(time.perf_counter() - started, func.__name__)
+
+# Schema migrations
+# Each migration is (version, description, steps). A step is an SQL statement
+# or a function taking the connection. init_db applies every version newer
+# than the one recorded in schema_version, each in its own transaction, so
+# existing bot_data.db files upgrade themselves on start. Never edit a
+# migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, "Base tables", [
+        # Table for ad configuration
+        '''
         CREATE TABLE IF NOT EXISTS ad_config (
             id INTEGER PRIMARY KEY CHECK (id = 1),
             photo_file_id TEXT,
@@ -58,10 +400,9 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Table for ad buttons (support multiple buttons)
-    c.execute('''
+        ''',
+        # Table for ad buttons (support multiple buttons)
+        '''
         CREATE TABLE IF NOT EXISTS ad_buttons (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             button_text TEXT NOT NULL,
@@ -69,10 +410,9 @@ def init_db():
             button_order INTEGER DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Table for join statistics
-    c.execute('''
+        ''',
+        # Table for join statistics
+        '''
         CREATE TABLE IF NOT EXISTS join_stats (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -82,314 +422,1464 @@ def init_db():
             chat_title TEXT,
             joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
-    
-    # Table for click tracking
-    c.execute('''
+        ''',
+        # Table for click tracking
+        '''
         CREATE TABLE IF NOT EXISTS ad_clicks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             username TEXT,
             clicked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    ''')
+        ''',
+    ]),
+    (2, "Incremental stats aggregates", [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            joins INTEGER NOT NULL DEFAULT 0,
+            clicks INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_chats (
+            chat_id INTEGER PRIMARY KEY,
+            joins INTEGER NOT NULL DEFAULT 0,
+            last_join_at TIMESTAMP
+        )
+        ''',
+        # Backfill from existing rows; OR IGNORE keeps aggregates that already exist
+        '''
+        INSERT OR IGNORE INTO stats_counters (name, value)
+        SELECT 'total_joins', COUNT(*) FROM join_stats
+        UNION ALL
+        SELECT 'total_clicks', COUNT(*) FROM ad_clicks
+        ''',
+        '''
+        INSERT OR IGNORE INTO stats_daily (day, joins, clicks)
+        SELECT day, SUM(joins), SUM(clicks) FROM (
+            SELECT date(joined_at) AS day, 1 AS joins, 0 AS clicks FROM join_stats
+            UNION ALL
+            SELECT date(clicked_at), 0, 1 FROM ad_clicks
+        ) GROUP BY day
+        ''',
+        '''
+        INSERT OR IGNORE INTO stats_chats (chat_id, joins, last_join_at)
+        SELECT chat_id, COUNT(*), MAX(joined_at) FROM join_stats GROUP BY chat_id
+        ''',
+    ]),
+    (3, "Hourly and daily rollups", [
+        '''
+        CREATE TABLE IF NOT EXISTS join_rollup_hourly (
+            hour TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            joins INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, chat_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS join_rollup_daily (
+            day TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            joins INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, chat_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS click_rollup_hourly (
+            hour TEXT PRIMARY KEY,
+            clicks INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+    (4, "Indexes for time windows, chats and users", [
+        'CREATE INDEX IF NOT EXISTS idx_join_stats_joined_at ON join_stats (joined_at)',
+        'CREATE INDEX IF NOT EXISTS idx_join_stats_chat_joined_at ON join_stats (chat_id, joined_at)',
+        'CREATE INDEX IF NOT EXISTS idx_join_stats_user_id ON join_stats (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_ad_clicks_clicked_at ON ad_clicks (clicked_at)',
+        'CREATE INDEX IF NOT EXISTS idx_ad_clicks_user_id ON ad_clicks (user_id)',
+    ]),
+    (5, "Persisted user data and conversation states", [
+        '''
+        CREATE TABLE IF NOT EXISTS persisted_user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS persisted_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (6, "Ad campaigns with weights, targeting and frequency caps", [
+        '''
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            photo_file_id TEXT,
+            message_text TEXT NOT NULL,
+            weight INTEGER NOT NULL DEFAULT 1 CHECK (weight > 0),
+            frequency_cap INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS campaign_buttons (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            button_text TEXT NOT NULL,
+            button_url TEXT NOT NULL,
+            button_order INTEGER DEFAULT 0
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_campaign_buttons_campaign_id ON campaign_buttons (campaign_id)',
+        # No rows for a campaign = shown in every chat
+        '''
+        CREATE TABLE IF NOT EXISTS campaign_chats (
+            campaign_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            PRIMARY KEY (campaign_id, chat_id)
+        ) WITHOUT ROWID
+        ''',
+        # How often each user has been shown a frequency-capped campaign
+        '''
+        CREATE TABLE IF NOT EXISTS campaign_impressions (
+            campaign_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            shown INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (campaign_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (7, "Welcome message log for repeat-joiner deduplication", [
+        # sent_at is a Unix timestamp; user_id doubles as the rowid to keep rows small
+        '''
+        CREATE TABLE IF NOT EXISTS welcome_log (
+            user_id INTEGER PRIMARY KEY,
+            sent_at INTEGER NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_welcome_log_sent_at ON welcome_log (sent_at)',
+    ]),
+    (8, "Campaign of each ad click", [
+        # NULL = the default /setad ad
+        'ALTER TABLE ad_clicks ADD COLUMN campaign_id INTEGER',
+    ]),
+    (9, "Durable outbox for welcome and ad DMs", [
+        # finished_at IS NULL = still to be sent; lease_until > now means a
+        # worker (owner) holds it in memory. Finished rows are kept for
+        # OUTBOX_KEEP_SECONDS so a redelivered join request is still ignored.
+        # Times are Unix timestamps.
+        '''
+        CREATE TABLE IF NOT EXISTS dm_outbox (
+            id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            kind TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            claims INTEGER NOT NULL DEFAULT 0,
+            finished_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_dm_outbox_pending ON dm_outbox (priority, id) WHERE finished_at IS NULL',
+        'CREATE INDEX IF NOT EXISTS idx_dm_outbox_finished_at ON dm_outbox (finished_at) WHERE finished_at IS NOT NULL',
+    ]),
+    (10, "Broadcast audience and checkpoints", [
+        # Everyone who ever joined; unlike join_stats it is never pruned
+        '''
+        CREATE TABLE IF NOT EXISTS audience (
+            user_id INTEGER PRIMARY KEY,
+            first_joined_at TIMESTAMP,
+            blocked_at TIMESTAMP
+        )
+        ''',
+        '''
+        INSERT OR IGNORE INTO audience (user_id, first_joined_at)
+        SELECT user_id, MIN(joined_at) FROM join_stats WHERE user_id IS NOT NULL GROUP BY user_id
+        ''',
+        # cursor = last user_id of the last finished batch; buttons is JSON [[text, url], ...]
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY,
+            photo_file_id TEXT,
+            message_text TEXT NOT NULL,
+            buttons TEXT NOT NULL,
+            status TEXT NOT NULL,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (11, "Join requests drained from the startup backlog", [
+        # Saved before Telegram is told they were received and deleted once
+        # handled; request is the ChatJoinRequest as JSON
+        '''
+        CREATE TABLE IF NOT EXISTS backlog_requests (
+            update_id INTEGER PRIMARY KEY,
+            request TEXT NOT NULL
+        )
+        ''',
+    ]),
+]
+
+def get_schema_version(conn):
+    """Get the newest migration applied to the database"""
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+# Database setup
+def init_db():
+    """Initialize the database and apply pending migrations"""
+    conn = get_db()
+    
+    # Incremental auto-vacuum lets the compaction job give space back in small steps.
+    # New databases get it from DB_PRAGMAS; switching an existing one over needs a
+    # full VACUUM (slow, and about the file's size in free disk), so that is opt-in.
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        if VACUUM_ON_START:
+            logger.warning(f"Running a full VACUUM on {DB_PATH} to enable incremental auto-vacuum; this may take a while")
+            conn.execute('VACUUM')
+        else:
+            logger.info("Incremental auto-vacuum is off for this database; set VACUUM_ON_START=1 once to enable it")
     
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     conn.commit()
-    conn.close()
+    
+    current = get_schema_version(conn)
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute('BEGIN')
+        try:
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(
+                'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                (version, description)
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.error(f"Schema migration {version} ({description}) failed")
+            raise
+        logger.info(f"Applied schema migration {version}: {description}")
 
 # Database helper functions
+@storage_function
 def get_ad_config():
     """Get current ad configuration"""
-    conn = sqlite3.connect('bot_data.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT photo_file_id, message_text FROM ad_config WHERE id = 1')
     result = c.fetchone()
-    conn.close()
     return result
 
+@storage_function
 def get_ad_buttons():
     """Get all ad buttons"""
-    conn = sqlite3.connect('bot_data.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('SELECT button_text, button_url FROM ad_buttons ORDER BY button_order, id')
     results = c.fetchall()
-    conn.close()
     return results
 
-def set_ad_config(photo_file_id=None, message_text=None):
-    """Set ad configuration"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    
-    # Check if config exists
-    c.execute('SELECT id FROM ad_config WHERE id = 1')
-    exists = c.fetchone()
-    
-    if exists:
-        # Update existing
-        updates = []
-        params = []
-        if photo_file_id is not None:
-            updates.append('photo_file_id = ?')
-            params.append(photo_file_id)
-        if message_text is not None:
-            updates.append('message_text = ?')
-            params.append(message_text)
-        
-        if updates:
-            updates.append('updated_at = CURRENT_TIMESTAMP')
-            query = f"UPDATE ad_config SET {', '.join(updates)} WHERE id = 1"
-            c.execute(query, params)
-    else:
-        # Insert new
-        c.execute('''
-            INSERT INTO ad_config (id, photo_file_id, message_text)
-            VALUES (1, ?, ?)
+@storage_function
+def save_ad(photo_file_id, message_text, buttons):
+    """Replace the ad and all its buttons in one transaction.
+
+    ``buttons`` is a list of (text, url) pairs. Returns the new ad as
+    load_ad() does, so the caller can swap its cache without another query.
+    """
+    conn = get_db()
+    with conn:
+        conn.execute('''
+            INSERT INTO ad_config (id, photo_file_id, message_text) VALUES (1, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                photo_file_id = excluded.photo_file_id,
+                message_text = excluded.message_text,
+                updated_at = CURRENT_TIMESTAMP
         ''', (photo_file_id, message_text))
-    
-    conn.commit()
-    conn.close()
+        conn.execute('DELETE FROM ad_buttons')
+        conn.executemany('''
+            INSERT INTO ad_buttons (button_text, button_url, button_order)
+            VALUES (?, ?, ?)
+        ''', [(text, url, order) for order, (text, url) in enumerate(buttons)])
+        bump_ad_version(conn)
+    return load_ad()
 
-def add_ad_button(button_text, button_url, button_order=0):
-    """Add an ad button"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO ad_buttons (button_text, button_url, button_order)
-        VALUES (?, ?, ?)
-    ''', (button_text, button_url, button_order))
-    conn.commit()
-    conn.close()
+@storage_function
+def clear_ad_config():
+    """Clear ad configuration and buttons; returns the (empty) ad like load_ad()"""
+    conn = get_db()
+    with conn:
+        conn.execute('DELETE FROM ad_config WHERE id = 1')
+        conn.execute('DELETE FROM ad_buttons')
+        bump_ad_version(conn)
+    return load_ad()
 
-def clear_ad_buttons():
-    """Clear all ad buttons"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM ad_buttons')
-    conn.commit()
-    conn.close()
+@storage_function
+def get_ad_version():
+    """Get the ad version, bumped on every admin edit"""
+    return get_counter(get_db(), 'ad_version')
 
-def clear_ad_config():
-    """Clear ad configuration and buttons"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM ad_config WHERE id = 1')
-    c.execute('DELETE FROM ad_buttons')
-    conn.commit()
-    conn.close()
+def bump_ad_version(conn):
+    """Mark the ad as changed so other workers reload it"""
+    conn.execute('''
+        INSERT INTO stats_counters (name, value) VALUES ('ad_version', 1)
+        ON CONFLICT(name) DO UPDATE SET value = value + 1
+    ''')
 
-def log_join(user_id, username, first_name, chat_id, chat_title):
-    """Log a user join"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO join_stats (user_id, username, first_name, chat_id, chat_title)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, username, first_name, chat_id, chat_title))
-    conn.commit()
-    conn.close()
+@storage_function
+def save_campaign(weight, frequency_cap, chat_ids, photo_file_id, message_text, buttons):
+    """Add a campaign with its buttons and target chats; returns the new ad like load_ad()"""
+    conn = get_db()
+    with conn:
+        campaign_id = conn.execute('''
+            INSERT INTO campaigns (photo_file_id, message_text, weight, frequency_cap)
+            VALUES (?, ?, ?, ?)
+        ''', (photo_file_id, message_text, weight, frequency_cap)).lastrowid
+        conn.executemany('''
+            INSERT INTO campaign_buttons (campaign_id, button_text, button_url, button_order)
+            VALUES (?, ?, ?, ?)
+        ''', [(campaign_id, text, url, order) for order, (text, url) in enumerate(buttons)])
+        conn.executemany(
+            'INSERT OR IGNORE INTO campaign_chats (campaign_id, chat_id) VALUES (?, ?)',
+            [(campaign_id, chat_id) for chat_id in chat_ids]
+        )
+        bump_ad_version(conn)
+    return load_ad()
 
-def log_click(user_id, username):
-    """Log an ad click"""
-    conn = sqlite3.connect('bot_data.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO ad_clicks (user_id, username)
-        VALUES (?, ?)
-    ''', (user_id, username))
-    conn.commit()
-    conn.close()
+@storage_function
+def delete_campaign(campaign_id):
+    """Remove a campaign and everything recorded for it; returns the new ad like load_ad()"""
+    conn = get_db()
+    with conn:
+        for table in ('campaigns', 'campaign_buttons', 'campaign_chats', 'campaign_impressions'):
+            column = 'id' if table == 'campaigns' else 'campaign_id'
+            conn.execute(f'DELETE FROM {table} WHERE {column} = ?', (campaign_id,))
+        bump_ad_version(conn)
+    return load_ad()
+
+def get_campaigns(conn):
+    """Read every campaign as [id, photo, text, weight, cap, buttons, chat_ids]"""
+    campaigns = {
+        row[0]: list(row) + [[], []]
+        for row in conn.execute(
+            'SELECT id, photo_file_id, message_text, weight, frequency_cap FROM campaigns ORDER BY id'
+        )
+    }
+    for campaign_id, button_text, button_url in conn.execute(
+        'SELECT campaign_id, button_text, button_url FROM campaign_buttons ORDER BY campaign_id, button_order, id'
+    ):
+        if campaign_id in campaigns:
+            campaigns[campaign_id][5].append((button_text, button_url))
+    for campaign_id, chat_id in conn.execute('SELECT campaign_id, chat_id FROM campaign_chats'):
+        if campaign_id in campaigns:
+            campaigns[campaign_id][6].append(chat_id)
+    return list(campaigns.values())
+
+@storage_function
+def claim_impression(campaign_id, user_id, frequency_cap):
+    """Count one more showing of a campaign to a user; False if the user hit the cap"""
+    conn = get_db()
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO campaign_impressions (campaign_id, user_id, shown) VALUES (?, ?, 1)
+            ON CONFLICT(campaign_id, user_id) DO UPDATE SET shown = shown + 1
+            WHERE shown < ?
+        ''', (campaign_id, user_id, frequency_cap))
+    return cursor.rowcount == 1
+
+@storage_function
+def get_campaign_reach():
+    """Get the number of users each frequency-capped campaign has reached"""
+    conn = get_db()
+    return conn.execute(
+        'SELECT campaign_id, COUNT(*) FROM campaign_impressions GROUP BY campaign_id'
+    ).fetchall()
+
+def utc_timestamp():
+    """Current UTC time in SQLite's CURRENT_TIMESTAMP format"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
 
+@storage_function
+def flush_events(joins, clicks, dms=(), done=()):
+    """Write a batch of join and click events and DM outbox changes in a single transaction"""
+    conn = get_db()
+    with conn:
+        if joins:
+            conn.executemany('''
+                INSERT INTO join_stats (user_id, username, first_name, chat_id, chat_title, joined_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', joins)
+            conn.executemany(
+                'INSERT OR IGNORE INTO audience (user_id, first_joined_at) VALUES (?, ?)',
+                [(row[0], row[5]) for row in joins]
+            )
+        if clicks:
+            conn.executemany('''
+                INSERT INTO ad_clicks (user_id, username, clicked_at, campaign_id)
+                VALUES (?, ?, ?, ?)
+            ''', clicks)
+        if dms:
+            # A redelivered join request carries the same key and is ignored
+            conn.executemany('''
+                INSERT OR IGNORE INTO dm_outbox (idempotency_key, kind, chat_id, payload, priority, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', dms)
+        if done:
+            conn.executemany('UPDATE dm_outbox SET finished_at = ?, lease_until = 0 WHERE id = ?', done)
+        update_stats_aggregates(conn, joins, clicks)
+
+def update_stats_aggregates(conn, joins, clicks):
+    """Fold a batch of events into the running totals and daily rollup"""
+    conn.executemany('''
+        INSERT INTO stats_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', [('total_joins', len(joins)), ('total_clicks', len(clicks))])
+    
+    # Timestamps are 'YYYY-MM-DD HH:MM:SS', so the first 10 characters are the day
+    daily_joins = Counter(row[5][:10] for row in joins)
+    daily_clicks = Counter(row[2][:10] for row in clicks)
+    conn.executemany('''
+        INSERT INTO stats_daily (day, joins, clicks) VALUES (?, ?, ?)
+        ON CONFLICT(day) DO UPDATE SET
+            joins = joins + excluded.joins,
+            clicks = clicks + excluded.clicks
+    ''', [(day, daily_joins[day], daily_clicks[day]) for day in daily_joins.keys() | daily_clicks.keys()])
+    
+    chat_joins = Counter(row[3] for row in joins)
+    last_join = {row[3]: row[5] for row in joins}
+    conn.executemany('''
+        INSERT INTO stats_chats (chat_id, joins, last_join_at) VALUES (?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET
+            joins = joins + excluded.joins,
+            last_join_at = max(last_join_at, excluded.last_join_at)
+    ''', [(chat_id, count, last_join[chat_id]) for chat_id, count in chat_joins.items()])
+
+@storage_function
 def get_stats(days=7):
     """Get statistics for the last N days"""
-    conn = sqlite3.connect('bot_data.db')
+    conn = get_db()
     c = conn.cursor()
     
-    # Calculate date threshold
-    date_threshold = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-    
-    # Total joins
-    c.execute('SELECT COUNT(*) FROM join_stats')
-    total_joins = c.fetchone()[0]
+    # Calculate date threshold (aggregates are kept per UTC day)
+    day_threshold = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d')
     
-    # Recent joins
-    c.execute('SELECT COUNT(*) FROM join_stats WHERE joined_at >= ?', (date_threshold,))
-    recent_joins = c.fetchone()[0]
+    # Totals
+    c.execute("SELECT name, value FROM stats_counters WHERE name IN ('total_joins', 'total_clicks')")
+    totals = dict(c.fetchall())
     
-    # Total clicks
-    c.execute('SELECT COUNT(*) FROM ad_clicks')
-    total_clicks = c.fetchone()[0]
-    
-    # Recent clicks
-    c.execute('SELECT COUNT(*) FROM ad_clicks WHERE clicked_at >= ?', (date_threshold,))
-    recent_clicks = c.fetchone()[0]
+    # Recent joins and clicks
+    c.execute('''
+        SELECT COALESCE(SUM(joins), 0), COALESCE(SUM(clicks), 0)
+        FROM stats_daily WHERE day >= ?
+    ''', (day_threshold,))
+    recent_joins, recent_clicks = c.fetchone()
     
     # Unique groups
-    c.execute('SELECT COUNT(DISTINCT chat_id) FROM join_stats')
+    c.execute('SELECT COUNT(*) FROM stats_chats')
     unique_groups = c.fetchone()[0]
     
-    conn.close()
-    
     return {
-        'total_joins': total_joins,
+        'total_joins': totals.get('total_joins', 0),
         'recent_joins': recent_joins,
-        'total_clicks': total_clicks,
+        'total_clicks': totals.get('total_clicks', 0),
         'recent_clicks': recent_clicks,
         'unique_groups': unique_groups,
         'days': days
     }
 
-# Check if user is admin
-def is_admin(user_id: int) -> bool:
-    """Check if user is the bot admin"""
-    return user_id == ADMIN_ID
+def get_counter(conn, name):
+    """Read a value from stats_counters"""
+    row = conn.execute('SELECT value FROM stats_counters WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else 0
 
-# Command handlers
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /start command"""
-    user = update.effective_user
-    first_name = user.first_name or "User"
-    
-    # Create the message text
-    message_text = (
-        f"Hello🎈 {first_name}!\n\n"
-        "I Accept Join Requests Automatically\n"
-        "Just ✨ Add Me To Your Channel ➕\n"
-        "Click /start To Know More ⭐⭐"
-    )
-    
-    # Create inline keyboard buttons
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "Add me to your group",
-                url=f"https://t.me/{BOT_USERNAME}?startgroup=s&admin=invite_users"
+def set_counter(conn, name, value):
+    """Store a value in stats_counters"""
+    conn.execute('''
+        INSERT INTO stats_counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value
+    ''', (name, value))
+
+@storage_function
+def rollup_events(chunk):
+    """Fold the next chunk of raw rows into the rollup tables; returns rows rolled up"""
+    conn = get_db()
+    rolled = 0
+    with conn:
+        # Joins: everything above the watermark id has not been rolled up yet
+        start = get_counter(conn, 'rollup_join_id')
+        end, count = conn.execute(
+            'SELECT MAX(id), COUNT(*) FROM (SELECT id FROM join_stats WHERE id > ? ORDER BY id LIMIT ?)',
+            (start, chunk)
+        ).fetchone()
+        if end is not None:
+            conn.execute('''
+                INSERT INTO join_rollup_hourly (hour, chat_id, joins)
+                SELECT substr(joined_at, 1, 13) || ':00:00', chat_id, COUNT(*)
+                FROM join_stats WHERE id > ? AND id <= ? GROUP BY 1, 2
+                ON CONFLICT(hour, chat_id) DO UPDATE SET joins = joins + excluded.joins
+            ''', (start, end))
+            conn.execute('''
+                INSERT INTO join_rollup_daily (day, chat_id, joins)
+                SELECT date(joined_at), chat_id, COUNT(*)
+                FROM join_stats WHERE id > ? AND id <= ? GROUP BY 1, 2
+                ON CONFLICT(day, chat_id) DO UPDATE SET joins = joins + excluded.joins
+            ''', (start, end))
+            set_counter(conn, 'rollup_join_id', end)
+            rolled += count
+        
+        # Clicks
+        start = get_counter(conn, 'rollup_click_id')
+        end, count = conn.execute(
+            'SELECT MAX(id), COUNT(*) FROM (SELECT id FROM ad_clicks WHERE id > ? ORDER BY id LIMIT ?)',
+            (start, chunk)
+        ).fetchone()
+        if end is not None:
+            conn.execute('''
+                INSERT INTO click_rollup_hourly (hour, clicks)
+                SELECT substr(clicked_at, 1, 13) || ':00:00', COUNT(*)
+                FROM ad_clicks WHERE id > ? AND id <= ? GROUP BY 1
+                ON CONFLICT(hour) DO UPDATE SET clicks = clicks + excluded.clicks
+            ''', (start, end))
+            set_counter(conn, 'rollup_click_id', end)
+            rolled += count
+    return rolled
+
+@storage_function
+def prune_events(raw_days, hourly_days, chunk):
+    """Delete one chunk of expired rows that are already rolled up; returns rows deleted"""
+    conn = get_db()
+    deleted = 0
+    now = datetime.now(timezone.utc)
+    with conn:
+        if raw_days:
+            cutoff = (now - timedelta(days=raw_days)).strftime('%Y-%m-%d %H:%M:%S')
+            deleted += conn.execute('''
+                DELETE FROM join_stats WHERE id IN (
+                    SELECT id FROM join_stats WHERE id <= ? AND joined_at < ? ORDER BY id LIMIT ?
+                )
+            ''', (get_counter(conn, 'rollup_join_id'), cutoff, chunk)).rowcount
+            deleted += conn.execute('''
+                DELETE FROM ad_clicks WHERE id IN (
+                    SELECT id FROM ad_clicks WHERE id <= ? AND clicked_at < ? ORDER BY id LIMIT ?
+                )
+            ''', (get_counter(conn, 'rollup_click_id'), cutoff, chunk)).rowcount
+        if hourly_days:
+            cutoff = (now - timedelta(days=hourly_days)).strftime('%Y-%m-%d %H:%M:%S')
+            deleted += conn.execute('DELETE FROM join_rollup_hourly WHERE hour < ?', (cutoff,)).rowcount
+            deleted += conn.execute('DELETE FROM click_rollup_hourly WHERE hour < ?', (cutoff,)).rowcount
+    return deleted
+
+@storage_function
+def prune_welcome_log(ttl, chunk):
+    """Delete one chunk of welcome_log rows older than the dedup window; returns rows deleted"""
+    conn = get_db()
+    with conn:
+        return conn.execute('''
+            DELETE FROM welcome_log WHERE user_id IN (
+                SELECT user_id FROM welcome_log WHERE sent_at < ? LIMIT ?
             )
-        ],
-        [
-            InlineKeyboardButton(
-                "Add me to your channel",
-                url=f"https://t.me/{BOT_USERNAME}?startchannel=s&admin=invite_users"
+        ''', (int(time.time()) - ttl, chunk)).rowcount
+
+@storage_function
+def prune_outbox(keep_seconds, chunk):
+    """Delete one chunk of DM jobs that finished longer ago than keep_seconds; returns rows deleted"""
+    conn = get_db()
+    with conn:
+        return conn.execute('''
+            DELETE FROM dm_outbox WHERE id IN (
+                SELECT id FROM dm_outbox WHERE finished_at < ? LIMIT ?
             )
-        ]
-    ]
-    
-    # Add admin button if user is admin
-    if is_admin(user.id):
-        keyboard.append([
-            InlineKeyboardButton("⚙️ Admin Panel", callback_data="admin_panel")
-        ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    # Send the message
-    await update.message.reply_text(
-        message_text,
-        reply_markup=reply_markup
-    )
+        ''', (time.time() - keep_seconds, chunk)).rowcount
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /help command"""
-    user = update.effective_user
-    
-    # Different help text for admin vs regular users
-    if is_admin(user.id):
-        # Admin sees full help with admin commands
-        help_text = (
-            "🤖 *Auto-Accept Bot Help*\n\n"
-            "This bot automatically accepts join requests for your private groups and channels.\n\n"
-            "*How to use:*\n"
-            "1. Add me to your private group or channel as admin\n"
-            "2. Give me 'Invite Users' permission\n"
-            "3. I will automatically accept all join requests!\n\n"
-            "*Commands:*\n"
-            "/start - Start the bot and get add links\n"
-            "/help - Show this help message\n\n"
-            "*Admin Commands:*\n"
-            "/setad - Set up advertisement\n"
-            "/viewad - View current ad\n"
-            "/clearad - Remove advertisement\n"
-            "/stats - View statistics\n\n"
-            "That's it! Simple and automatic! ✨"
-        )
-    else:
-        # Regular users see basic help only
-        help_text = (
-            "🤖 *Auto-Accept Bot Help*\n\n"
-            "This bot automatically accepts join requests for your private groups and channels.\n\n"
-            "*How to use:*\n"
-            "1. Add me to your private group or channel as admin\n"
-            "2. Give me 'Invite Users' permission\n"
-            "3. I will automatically accept all join requests!\n\n"
-            "*Commands:*\n"
-            "/start - Start the bot and get add links\n"
-            "/help - Show this help message\n\n"
-            "That's it! Simple and automatic! ✨"
-        )
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+@storage_function
+def incremental_vacuum(pages):
+    """Return up to N free pages to the filesystem"""
+    get_db().execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
 
-# Admin command handlers
-async def setad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Start the ad setup process"""
-    if not is_admin(update.effective_user.id):
-        # Don't reveal this is an admin command - just ignore or send generic message
-        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
-        return ConversationHandler.END
-    
-    await update.message.reply_text(
-        "📸 *Setup Advertisement*\n\n"
-        "Step 1/3: Send me a photo for the ad\n"
-        "Or send /skip to use text only",
-        parse_mode='Markdown'
-    )
-    return WAITING_FOR_PHOTO
+async def compact_database():
+    """Roll up, prune and vacuum in small steps so the database thread stays responsive"""
+    rolled = deleted = 0
+    while True:
+        count = await run_db(rollup_events, COMPACTION_CHUNK)
+        rolled += count
+        if count < COMPACTION_CHUNK:
+            break
+    while True:
+        count = await run_db(prune_events, RAW_RETENTION_DAYS, HOURLY_RETENTION_DAYS, COMPACTION_CHUNK)
+        deleted += count
+        if count < COMPACTION_CHUNK:
+            break
+    while WELCOME_DEDUP_SECONDS:
+        count = await run_db(prune_welcome_log, WELCOME_DEDUP_SECONDS, COMPACTION_CHUNK)
+        deleted += count
+        if count < COMPACTION_CHUNK:
+            break
+    while True:
+        count = await run_db(prune_outbox, OUTBOX_KEEP_SECONDS, COMPACTION_CHUNK)
+        deleted += count
+        if count < COMPACTION_CHUNK:
+            break
+    await run_db(incremental_vacuum, VACUUM_PAGES)
+    logger.info(f"Compaction done: {rolled} rows rolled up, {deleted} rows pruned")
 
-async def receive_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Receive photo for ad"""
-    if update.message.photo:
-        # Get the largest photo
-        photo = update.message.photo[-1]
-        context.user_data['ad_photo'] = photo.file_id
-        
-        await update.message.reply_text(
-            "✅ Photo received!\n\n"
-            "Step 2/3: Send me the message text for the ad"
-        )
-        return WAITING_FOR_TEXT
-    else:
-        await update.message.reply_text("Please send a photo or /skip")
-        return WAITING_FOR_PHOTO
+async def compaction_loop():
+    """Run compact_database every COMPACTION_INTERVAL seconds"""
+    while True:
+        try:
+            await compact_database()
+        except sqlite3.Error as e:
+            logger.error(f"Compaction failed: {e}")
+        await asyncio.sleep(COMPACTION_INTERVAL)
 
-async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Skip photo step"""
-    context.user_data['ad_photo'] = None
-    await update.message.reply_text(
-        "⏭️ Photo skipped\n\n"
-        "Step 2/3: Send me the message text for the ad"
-    )
-    return WAITING_FOR_TEXT
+# Storage backends
+class StoreError(sqlite3.Error):
+    """Raised when a remote store call fails; ``transient`` when a retry may succeed"""
 
-async def receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Receive message text for ad"""
-    context.user_data['ad_text'] = update.message.text
-    
-    await update.message.reply_text(
-        "✅ Message text received!\n\n"
-        "Step 3/3: Send me the button details in this format:\n"
-        "`Button Text | https://example.com`\n\n"
-        "Example:\n"
-        "`🎁 Visit Our Sponsor | https://t.me/yourchannel`\n\n"
-        "Or send /skip to have no button",
-        parse_mode='Markdown'
-    )
-    return WAITING_FOR_BUTTON
+    def __init__(self, message, transient=False):
+        super().__init__(message)
+        self.transient = transient
 
-async def receive_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Receive button details for ad"""
-    text = update.message.text
-    
-    if '|' not in text:
+def is_transient_db_error(error):
+    """Whether a failed database call may succeed if retried (locked, busy, store unreachable)"""
+    return isinstance(error, sqlite3.OperationalError) or getattr(error, 'transient', False)
+
+
+class LocalStore:
+    """Runs database helpers on this process's database thread"""
+
+    async def call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        await self.call(close_db)
+        DB_EXECUTOR.shutdown(wait=True)
+
+
+class RemoteStore:
+    """Sends database helper calls to a store server over TCP.
+
+    The protocol is one JSON object per line: after an ``auth`` line the client
+    sends ``{"id", "fn", "args", "kwargs"}`` and the server answers in order
+    with ``{"id", "result"}`` or ``{"id", "error"}``. Only functions
+    registered with @storage_function can be called, and arguments and
+    results must be JSON-serializable.
+    """
+
+    def __init__(self, url, secret):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.secret = secret
+        self._writer = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._connect_lock = asyncio.Lock()
+        self._reader_task = None
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port, limit=2 ** 24)
+            except OSError as e:
+                raise StoreError(f"Cannot reach store at {self.host}:{self.port}: {e}", transient=True)
+            writer.write(json.dumps({'auth': self.secret}).encode() + b'\n')
+            self._writer = writer
+            self._reader_task = asyncio.create_task(self._read_responses(reader, writer))
+
+    async def _read_responses(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(StoreError(response['error'], response.get('transient', False)))
+                else:
+                    future.set_result(response['result'])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Store connection error: {e}")
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(StoreError("Connection to store lost", transient=True))
+            self._pending.clear()
+
+    async def call(self, func, *args, **kwargs):
+        if func.__name__ not in STORAGE_FUNCTIONS:
+            raise ValueError(f"{func.__name__} is not a registered storage function")
+        if self._writer is None:
+            await self._connect()
+        
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        request = {'id': request_id, 'fn': func.__name__, 'args': args, 'kwargs': kwargs}
+        try:
+            self._writer.write(json.dumps(request).encode() + b'\n')
+            await self._writer.drain()
+        except (OSError, AttributeError) as e:
+            self._pending.pop(request_id, None)
+            raise StoreError(f"Could not send {func.__name__} to store: {e}", transient=True)
+        return await future
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+
+
+LOCAL_STORE = LocalStore()
+STORE = RemoteStore(STORE_URL, STORE_SECRET) if STORE_URL else LOCAL_STORE
+
+async def handle_store_client(reader, writer):
+    """Serve storage calls from one remote worker, in order"""
+    try:
+        auth = json.loads(await reader.readline() or b'{}')
+        if not hmac.compare_digest(str(auth.get('auth', '')).encode(), STORE_SECRET.encode()):
+            logger.warning("Rejected store client with a bad secret")
+            return
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            request = json.loads(line)
+            func = STORAGE_FUNCTIONS.get(request.get('fn'))
+            try:
+                if func is None:
+                    raise ValueError(f"Unknown storage function {request.get('fn')!r}")
+                result = await LOCAL_STORE.call(func, *request.get('args', []), **request.get('kwargs', {}))
+                response = {'id': request['id'], 'result': result}
+            except Exception as e:
+                response = {'id': request['id'], 'error': f"{type(e).__name__}: {e}", 'transient': is_transient_db_error(e)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Store client error: {e}")
+    finally:
+        writer.close()
+
+async def start_store_server(listen):
+    """Start serving the local database to remote workers"""
+    host, port = listen.rsplit(':', 1)
+    server = await asyncio.start_server(handle_store_client, host, int(port), limit=2 ** 24)
+    logger.info(f"Store server listening on {listen}")
+    return server
+
+# Ad cache
+# The join path renders the ad from this in-memory snapshot; it is rebuilt
+# only when the admin changes the ad, so sending a welcome costs no DB reads.
+AdSnapshot = namedtuple('AdSnapshot', ['photo_id', 'message_text', 'reply_markup', 'message', 'buttons', 'campaign_id'])
+Campaign = namedtuple('Campaign', ['id', 'weight', 'frequency_cap', 'chat_ids', 'ad'])
+AD_CACHE = None  # AdSnapshot, or None when no ad is configured
+AD_CACHE_VERSION = None
+
+@storage_function
+def load_ad():
+    """Read the ad config, its buttons, the campaigns and the ad version together"""
+    return get_ad_config(), get_ad_buttons(), get_ad_version(), get_campaigns(get_db())
+
+def build_ad_snapshot(ad_config, ad_buttons, campaign_id=None):
+    """Prebuild the caption and keyboard for an ad"""
+    if not ad_config or not ad_config[1]:  # Check if message_text exists
+        return None
+    
+    photo_id, message_text = ad_config
+    reply_markup = None
+    if ad_buttons:
+        keyboard = []
+        for button_text, button_url in ad_buttons:
+            keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    # Ready-made (method, kwargs) pair for the send queue
+    if photo_id:
+        message = ('send_photo', {'photo': photo_id, 'caption': message_text, 'reply_markup': reply_markup})
+    else:
+        message = ('send_message', {'text': message_text, 'reply_markup': reply_markup})
+    return AdSnapshot(photo_id, message_text, reply_markup, message, ad_buttons, campaign_id)
+
+class CampaignIndex:
+    """Campaigns eligible in each chat, with cumulative weights.
+
+    Built once per ad change. A chat maps to its targeted campaigns plus the
+    untargeted ones; any other chat gets the untargeted ones only. Picking is
+    a bisect over the cumulative weights, O(log n) per join.
+    """
+
+    def __init__(self, campaigns):
+        self.campaigns = {campaign.id: campaign for campaign in campaigns}
+        untargeted = [campaign for campaign in campaigns if not campaign.chat_ids]
+        targeted = {}
+        for campaign in campaigns:
+            for chat_id in campaign.chat_ids:
+                targeted.setdefault(chat_id, []).append(campaign)
+        self._default = self._table(untargeted)
+        self._by_chat = {chat_id: self._table(eligible + untargeted) for chat_id, eligible in targeted.items()}
+
+    @staticmethod
+    def _table(campaigns):
+        return campaigns, list(itertools.accumulate(campaign.weight for campaign in campaigns))
+
+    def pick(self, chat_id, exclude=()):
+        """Draw a campaign for a join in this chat, or None if none is eligible"""
+        campaigns, cumulative = self._by_chat.get(chat_id, self._default)
+        if exclude:
+            # Only after a frequency cap was hit, so rebuilding the small table is fine
+            campaigns, cumulative = self._table([campaign for campaign in campaigns if campaign.id not in exclude])
+        if not campaigns:
+            return None
+        return campaigns[bisect.bisect_right(cumulative, random.random() * cumulative[-1])]
+
+CAMPAIGNS = CampaignIndex([])
+
+def install_ad(loaded):
+    """Swap in a freshly loaded (config, buttons, version, campaigns) ad in one step"""
+    global AD_CACHE, AD_CACHE_VERSION, CAMPAIGNS
+    ad_config, ad_buttons, version, campaigns = loaded
+    campaign_index = CampaignIndex([
+        Campaign(campaign_id, weight, frequency_cap, chat_ids, build_ad_snapshot((photo_id, text), buttons, campaign_id))
+        for campaign_id, photo_id, text, weight, frequency_cap, buttons, chat_ids in campaigns
+    ])
+    AD_CACHE = build_ad_snapshot(ad_config, ad_buttons)
+    AD_CACHE_VERSION = version
+    CAMPAIGNS = campaign_index
+
+async def pick_ad(chat_id, user_id):
+    """Choose the ad for a join: a weighted campaign for the chat, else the default ad"""
+    capped = set()
+    for _ in range(CAMPAIGN_PICK_ATTEMPTS):
+        campaign = CAMPAIGNS.pick(chat_id, capped)
+        if campaign is None:
+            break
+        if not campaign.frequency_cap:
+            return campaign.ad
+        capped.add(campaign.id)
+        try:
+            if await run_db(claim_impression, campaign.id, user_id, campaign.frequency_cap):
+                return campaign.ad
+        except sqlite3.Error as e:
+            logger.warning(f"Could not check the frequency cap of campaign {campaign.id}: {e}")
+    return AD_CACHE
+
+async def refresh_ad_cache():
+    """Reload the ad from the database and swap it in"""
+    install_ad(await run_db(load_ad))
+
+async def publish_ad_change(func, *args):
+    """Apply an admin edit and swap in the resulting ad, in one database round trip"""
+    install_ad(await run_db(func, *args))
+
+# Click tracking
+# With CLICK_BASE_URL set, each ad button points at the built-in HTTP server
+# instead of its target. The link carries the user, campaign and target URL,
+# signed with CLICK_SECRET, so a click is logged and redirected without any
+# database lookup, and links keep working after the ad is edited.
+def encode_click_token(user_id, campaign_id, url):
+    """Build the signed path segment of a tracked link"""
+    payload = base64.urlsafe_b64encode(
+        json.dumps([user_id, campaign_id, url], separators=(',', ':')).encode()
+    ).rstrip(b'=')
+    signature = base64.urlsafe_b64encode(
+        hmac.new(CLICK_SECRET.encode(), payload, hashlib.sha256).digest()[:12]
+    )
+    return f"{payload.decode()}.{signature.decode()}"
+
+def decode_click_token(token):
+    """Get (user_id, campaign_id, url) back from a tracked link, or None if it was tampered with"""
+    payload, _, signature = token.encode().partition(b'.')
+    expected = base64.urlsafe_b64encode(hmac.new(CLICK_SECRET.encode(), payload, hashlib.sha256).digest()[:12])
+    if not hmac.compare_digest(signature, expected):
+        return None
+    try:
+        user_id, campaign_id, url = json.loads(base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+    except ValueError:
+        return None
+    return user_id, campaign_id, url
+
+def tracked_ad_message(ad, user_id):
+    """The ad's send-queue message with buttons rewritten to tracked links for this user"""
+    method, kwargs = ad.message
+    if not CLICK_BASE_URL or not ad.buttons:
+        return ad.message
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            button_text,
+            url=f"{CLICK_BASE_URL}/c/{encode_click_token(user_id, ad.campaign_id, button_url)}"
+        )]
+        for button_text, button_url in ad.buttons
+    ])
+    return method, dict(kwargs, reply_markup=keyboard)
+
+class MetricsHandler(web.RequestHandler):
+    """GET /metrics: Prometheus scrape endpoint"""
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render_metrics())
+
+class ClickRedirectHandler(web.RequestHandler):
+    """GET /c/<token>: queue the click on the journal and 302 to the ad's URL"""
+
+    async def get(self, token):
+        click = decode_click_token(token)
+        if click is None:
+            raise web.HTTPError(404)
+        user_id, campaign_id, url = click
+        await JOURNAL.log_click(user_id, "", campaign_id)
+        self.set_header('Cache-Control', 'no-store')
+        self.redirect(url if '://' in url else f"https://{url}")
+
+async def ad_refresh_loop():
+    """Pick up ad edits made through other workers sharing the store"""
+    while True:
+        await asyncio.sleep(AD_REFRESH_INTERVAL)
+        try:
+            if await run_db(get_ad_version) != AD_CACHE_VERSION:
+                await refresh_ad_cache()
+        except sqlite3.Error as e:
+            logger.warning(f"Could not check for ad changes: {e}")
+
+# Write-behind event journal
+class EventJournal:
+    """Buffers join/click events and DM outbox changes in memory and writes them in batches.
+
+    A batch is flushed once JOURNAL_BATCH_SIZE events are pending or
+    JOURNAL_FLUSH_MS has passed since the first one arrived. The buffer is
+    bounded: when it is full, producers wait (backpressure) instead of
+    dropping events, and the wait is counted in ``stats``.
+
+    A batch that fails with a transient error (database locked, store
+    unreachable) is retried with backoff, up to JOURNAL_MAX_RETRIES times.
+    Any other error, or running out of retries, writes the batch one event at
+    a time so only the events that cannot be written are dropped (and logged).
+    """
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        self._batch_ready = asyncio.Event()
+        self._task = None
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'failed_batches': 0,
+            'dropped': 0,
+            'blocked_puts': 0,
+            'blocked_seconds': 0.0,
+            'max_depth': 0,
+        }
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    async def log_join(self, user_id, username, first_name, chat_id, chat_title):
+        """Queue a user join"""
+        await self._put(('join', (user_id, username, first_name, chat_id, chat_title, utc_timestamp())))
+
+    async def log_click(self, user_id, username, campaign_id=None):
+        """Queue an ad click"""
+        await self._put(('click', (user_id, username, utc_timestamp(), campaign_id)))
+
+    async def log_dm(self, key, kind, chat_id, payload, priority):
+        """Queue a DM job for the outbox"""
+        await self._put(('dm', (key, kind, chat_id, json.dumps(payload), priority, time.time())))
+
+    async def log_dm_done(self, job_id):
+        """Queue marking a DM job as finished in the outbox"""
+        await self._put(('dm_done', (time.time(), job_id)))
+
+    async def _put(self, event):
+        if self._queue.full():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            self.stats['blocked_puts'] += 1
+            self._batch_ready.set()
+            await self._queue.put(event)
+            self.stats['blocked_seconds'] += loop.time() - started
+        else:
+            self._queue.put_nowait(event)
+        self.stats['queued'] += 1
+        depth = self._queue.qsize()
+        if depth > self.stats['max_depth']:
+            self.stats['max_depth'] = depth
+        if depth >= self.batch_size or self._queue.full():
+            self._batch_ready.set()
+
+    def start(self):
+        """Start the background flusher"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still buffered and stop the flusher"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        self._batch_ready.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if first is not None and self._queue.qsize() < self.batch_size - 1:
+                try:
+                    await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._batch_ready.clear()
+            
+            batch = [first]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            stopping = None in batch
+            await self._write([event for event in batch if event is not None])
+            if stopping:
+                return
+
+    async def _write(self, batch):
+        if not batch:
+            return
+        joins = [row for kind, row in batch if kind == 'join']
+        clicks = [row for kind, row in batch if kind == 'click']
+        dms = [row for kind, row in batch if kind == 'dm']
+        done = [row for kind, row in batch if kind == 'dm_done']
+        delay = 0.5
+        for attempt in range(JOURNAL_MAX_RETRIES + 1):
+            try:
+                await run_db(flush_events, joins, clicks, dms, done)
+            except sqlite3.Error as e:
+                self.stats['failed_batches'] += 1
+                if not is_transient_db_error(e) or attempt == JOURNAL_MAX_RETRIES:
+                    logger.error(f"Could not write {len(batch)} journal events, writing them one by one: {e}")
+                    await self._write_each(batch)
+                    break
+                # Keep the batch and retry; the bounded queue applies backpressure meanwhile
+                logger.error(f"Could not write {len(batch)} journal events, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                self.stats['written'] += len(batch)
+                break
+        self.stats['batches'] += 1
+        if dms:
+            SEND_QUEUE.wake()
+
+    async def _write_each(self, batch):
+        """Write events one per transaction, dropping the ones that fail"""
+        for kind, row in batch:
+            try:
+                await run_db(
+                    flush_events,
+                    [row] if kind == 'join' else [],
+                    [row] if kind == 'click' else [],
+                    [row] if kind == 'dm' else [],
+                    [row] if kind == 'dm_done' else [],
+                )
+            except sqlite3.Error as e:
+                self.stats['dropped'] += 1
+                logger.error(f"Dropped {kind} event {json.dumps(row, default=str)}: {e}")
+            else:
+                self.stats['written'] += 1
+
+JOURNAL = EventJournal(JOURNAL_BATCH_SIZE, JOURNAL_FLUSH_MS / 1000, JOURNAL_MAX_PENDING)
+GaugeMetric('bot_journal_depth', "Join/click events waiting to be written", lambda: JOURNAL.depth)
+GaugeMetric('bot_journal_blocked_seconds', "Total time producers waited on a full journal", lambda: JOURNAL.stats['blocked_seconds'])
+
+# Persistence for user_data and conversation states
+@storage_function
+def load_user_data():
+    """Get every persisted user_data entry as (user_id, JSON) rows"""
+    conn = get_db()
+    return conn.execute('SELECT user_id, data FROM persisted_user_data').fetchall()
+
+@storage_function
+def load_conversations(name):
+    """Get the persisted states of one conversation as (key JSON, state JSON) rows"""
+    conn = get_db()
+    return conn.execute(
+        'SELECT key, state FROM persisted_conversations WHERE name = ?', (name,)
+    ).fetchall()
+
+@storage_function
+def save_persistence(users, conversations):
+    """Write changed user_data and conversation states in a single transaction.
+
+    ``users`` holds (user_id, JSON) and ``conversations`` holds (name, key JSON,
+    state JSON) rows; a JSON value of None deletes the row.
+    """
+    conn = get_db()
+    with conn:
+        conn.executemany('''
+            INSERT INTO persisted_user_data (user_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+        ''', [(user_id, data) for user_id, data in users if data is not None])
+        conn.executemany(
+            'DELETE FROM persisted_user_data WHERE user_id = ?',
+            [(user_id,) for user_id, data in users if data is None]
+        )
+        conn.executemany('''
+            INSERT INTO persisted_conversations (name, key, state, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(name, key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+        ''', [row for row in conversations if row[2] is not None])
+        conn.executemany(
+            'DELETE FROM persisted_conversations WHERE name = ? AND key = ?',
+            [(name, key) for name, key, state in conversations if state is None]
+        )
+
+class SQLitePersistence(BasePersistence):
+    """Keeps user_data and conversation states in the bot database.
+
+    The Application hands over every touched user on each PERSISTENCE_INTERVAL
+    run. Each value is compared with the JSON last seen for it, only real
+    changes are buffered, and the buffer is written in one transaction per run.
+    Users with empty user_data (everyone who only sent a join request) are
+    never written at all.
+    """
+
+    def __init__(self, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._users = {}  # user_id -> JSON of the latest known user_data
+        self._states = {}  # (name, key JSON) -> JSON of the latest known state
+        self._pending_users = {}  # user_id -> JSON, or None to delete
+        self._pending_states = {}  # (name, key JSON) -> JSON, or None to delete
+        self._write_task = None
+        self._closing = asyncio.Event()  # set by flush() to cut a retry backoff short
+        self.stats = {'writes': 0, 'rows': 0, 'skipped': 0, 'failed_writes': 0}
+
+    async def get_user_data(self):
+        rows = await run_db(load_user_data)
+        self._users = {user_id: data for user_id, data in rows}
+        return {user_id: json.loads(data) for user_id, data in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        conversations = {}
+        for key, state in await run_db(load_conversations, name):
+            self._states[(name, key)] = state
+            conversations[tuple(json.loads(key))] = json.loads(state)
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        state = None if new_state is None else json.dumps(new_state)
+        self._buffer(self._states, self._pending_states, (name, json.dumps(key)), state)
+
+    async def update_user_data(self, user_id, data):
+        self._buffer(self._users, self._pending_users, user_id, json.dumps(data, sort_keys=True) if data else None)
+
+    async def drop_user_data(self, user_id):
+        self._buffer(self._users, self._pending_users, user_id, None)
+
+    async def update_chat_data(self, chat_id, data):
+        """Chat data is not persisted"""
+
+    async def update_bot_data(self, data):
+        """Bot data is not persisted"""
+
+    async def update_callback_data(self, data):
+        """Callback data is not persisted"""
+
+    async def drop_chat_data(self, chat_id):
+        """Chat data is not persisted"""
+
+    async def refresh_user_data(self, user_id, user_data):
+        """Nothing to reload: user_data is only written from the user's private chat,
+        which shard_for always routes to the same process, so memory is current"""
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        """Chat data is not persisted"""
+
+    async def refresh_bot_data(self, bot_data):
+        """Bot data is not persisted"""
+
+    def _buffer(self, known, pending, key, value):
+        """Queue a value for writing unless it matches what was seen last"""
+        if known.get(key) == value:
+            self.stats['skipped'] += 1
+            return
+        if value is None:
+            known.pop(key, None)
+        else:
+            known[key] = value
+        pending[key] = value
+        # The Application calls update_* for every touched entry at once;
+        # one task then writes whatever they buffered together.
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write())
+
+    async def _write(self):
+        """Write buffered changes until none are left, backing off while writes fail"""
+        delay = 0.5
+        try:
+            # Changes buffered while a write is in flight go out right after it
+            while self._pending_users or self._pending_states:
+                try:
+                    await self._write_pending()
+                    delay = 0.5
+                except sqlite3.Error as e:
+                    if self._closing.is_set():
+                        return
+                    logger.error(f"Could not persist changes, retrying in {delay}s: {e}")
+                    try:
+                        await asyncio.wait_for(self._closing.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    delay = min(delay * 2, 30)
+        finally:
+            self._write_task = None
+
+    async def _write_pending(self):
+        """Write the buffered changes in one transaction; on failure they are buffered again"""
+        users, self._pending_users = self._pending_users, {}
+        states, self._pending_states = self._pending_states, {}
+        try:
+            await run_db(
+                save_persistence,
+                list(users.items()),
+                [(name, key, state) for (name, key), state in states.items()]
+            )
+        except sqlite3.Error:
+            # Keep the changes unless something newer replaced them meanwhile
+            self.stats['failed_writes'] += 1
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            for key, state in states.items():
+                self._pending_states.setdefault(key, state)
+            raise
+        self.stats['writes'] += 1
+        self.stats['rows'] += len(users) + len(states)
+
+    async def flush(self):
+        """Write everything still buffered; called once on shutdown"""
+        self._closing.set()
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending_users or self._pending_states:
+            try:
+                await self._write_pending()
+            except sqlite3.Error as e:
+                logger.error(f"Could not persist {len(self._pending_users) + len(self._pending_states)} changes: {e}")
+
+# Check if user is admin
+def is_admin(user_id: int) -> bool:
+    """Check if user is the bot admin"""
+    return user_id == ADMIN_ID
+
+# Command handlers
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /start command"""
+    user = update.effective_user
+    reply_markup = ADMIN_START_KEYBOARD if is_admin(user.id) else START_KEYBOARD
+    
+    # Messages reach this user now, even if a broadcast found them unreachable before
+    await run_db(mark_user_reachable, user.id)
+    
+    # Send the message
+    await update.message.reply_text(
+        welcome_text(user.first_name),
+        reply_markup=reply_markup
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /help command"""
+    user = update.effective_user
+    
+    # Different help text for admin vs regular users
+    if is_admin(user.id):
+        # Admin sees full help with admin commands
+        help_text = (
+            "🤖 *Auto-Accept Bot Help*\n\n"
+            "This bot automatically accepts join requests for your private groups and channels.\n\n"
+            "*How to use:*\n"
+            "1. Add me to your private group or channel as admin\n"
+            "2. Give me 'Invite Users' permission\n"
+            "3. I will automatically accept all join requests!\n\n"
+            "*Commands:*\n"
+            "/start - Start the bot and get add links\n"
+            "/help - Show this help message\n\n"
+            "*Admin Commands:*\n"
+            "/setad - Set up advertisement\n"
+            "/viewad - View current ad\n"
+            "/clearad - Remove advertisement\n"
+            "/newcampaign - Add a weighted/targeted campaign\n"
+            "/campaigns - List campaigns\n"
+            "/delcampaign - Remove a campaign\n"
+            "/stats - View statistics\n"
+            "/broadcast - Send the ad to everyone who joined\n"
+            "/export - Download join/click history as CSV\n"
+            "/profile - Profile the bot for N seconds\n\n"
+            "That's it! Simple and automatic! ✨"
+        )
+    else:
+        # Regular users see basic help only
+        help_text = (
+            "🤖 *Auto-Accept Bot Help*\n\n"
+            "This bot automatically accepts join requests for your private groups and channels.\n\n"
+            "*How to use:*\n"
+            "1. Add me to your private group or channel as admin\n"
+            "2. Give me 'Invite Users' permission\n"
+            "3. I will automatically accept all join requests!\n\n"
+            "*Commands:*\n"
+            "/start - Start the bot and get add links\n"
+            "/help - Show this help message\n\n"
+            "That's it! Simple and automatic! ✨"
+        )
+    
+    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+# Admin command handlers
+async def setad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start the ad setup process"""
+    if not is_admin(update.effective_user.id):
+        # Don't reveal this is an admin command - just ignore or send generic message
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return ConversationHandler.END
+    
+    context.user_data.pop('campaign', None)
+    await update.message.reply_text(
+        "📸 *Setup Advertisement*\n\n"
+        "Step 1/3: Send me a photo for the ad\n"
+        "Or send /skip to use text only",
+        parse_mode='Markdown'
+    )
+    return WAITING_FOR_PHOTO
+
+async def newcampaign_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Start setting up an extra campaign: /newcampaign <weight> [cap] [chat_id ...]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return ConversationHandler.END
+    
+    try:
+        numbers = [int(arg) for arg in context.args]
+    except ValueError:
+        numbers = []
+    if not numbers or numbers[0] < 1 or (len(numbers) > 1 and numbers[1] < 0):
+        await update.message.reply_text(
+            "❌ Usage: `/newcampaign <weight> [cap] [chat_id ...]`\n\n"
+            "• *weight* - share of joins (e.g. 3 is shown 3x as often as 1)\n"
+            "• *cap* - max times one user sees it, 0 = no limit\n"
+            "• *chat_id* - only show in these chats, none = all chats\n\n"
+            "Example: `/newcampaign 2 1 -1001234567890`",
+            parse_mode='Markdown'
+        )
+        return ConversationHandler.END
+    
+    context.user_data['campaign'] = {
+        'weight': numbers[0],
+        'cap': numbers[1] if len(numbers) > 1 else 0,
+        'chat_ids': numbers[2:],
+    }
+    await update.message.reply_text(
+        "📸 *New Campaign*\n\n"
+        "Step 1/3: Send me a photo for the campaign\n"
+        "Or send /skip to use text only",
+        parse_mode='Markdown'
+    )
+    return WAITING_FOR_PHOTO
+
+async def receive_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Receive photo for ad"""
+    if update.message.photo:
+        # Get the largest photo
+        photo = update.message.photo[-1]
+        context.user_data['ad_photo'] = photo.file_id
+        
+        await update.message.reply_text(
+            "✅ Photo received!\n\n"
+            "Step 2/3: Send me the message text for the ad"
+        )
+        return WAITING_FOR_TEXT
+    else:
+        await update.message.reply_text("Please send a photo or /skip")
+        return WAITING_FOR_PHOTO
+
+async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Skip photo step"""
+    context.user_data['ad_photo'] = None
+    await update.message.reply_text(
+        "⏭️ Photo skipped\n\n"
+        "Step 2/3: Send me the message text for the ad"
+    )
+    return WAITING_FOR_TEXT
+
+async def receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Receive message text for ad"""
+    context.user_data['ad_text'] = update.message.text
+    
+    await update.message.reply_text(
+        "✅ Message text received!\n\n"
+        "Step 3/3: Send me the button details in this format:\n"
+        "`Button Text | https://example.com`\n\n"
+        "Example:\n"
+        "`🎁 Visit Our Sponsor | https://t.me/yourchannel`\n\n"
+        "Or send /skip to have no button",
+        parse_mode='Markdown'
+    )
+    return WAITING_FOR_BUTTON
+
+async def receive_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Receive button details for ad"""
+    text = update.message.text
+    
+    if '|' not in text:
         await update.message.reply_text(
             "❌ Invalid format. Please use:\n"
             "`Button Text | https://example.com`",
@@ -478,25 +1968,37 @@ async def finish_ad_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     ad_text = context.user_data.get('ad_text')
     ad_buttons = context.user_data.get('ad_buttons', [])
     
-    # Clear existing buttons first
-    clear_ad_buttons()
-    
-    # Save ad config
-    set_ad_config(
-        photo_file_id=photo_id,
-        message_text=ad_text
-    )
-    
-    # Save buttons
-    for idx, button in enumerate(ad_buttons):
-        add_ad_button(
-            button_text=button['text'],
-            button_url=button['url'],
-            button_order=idx
-        )
-    
+    buttons = [(button['text'], button['url']) for button in ad_buttons]
     button_count = len(ad_buttons)
-    await update.message.reply_text(
+    campaign = context.user_data.get('campaign')
+    
+    if campaign:
+        await publish_ad_change(
+            save_campaign,
+            campaign['weight'],
+            campaign['cap'],
+            campaign['chat_ids'],
+            photo_id,
+            ad_text,
+            buttons
+        )
+        await update.message.reply_text(
+            f"✅ *Campaign Saved!*\n\n"
+            f"📸 Photo: {'Yes' if photo_id else 'No'}\n"
+            f"🔘 Buttons: {button_count}\n"
+            f"⚖️ Weight: {campaign['weight']}\n"
+            f"🔁 Cap per user: {campaign['cap'] or 'No limit'}\n"
+            f"🎯 Chats: {len(campaign['chat_ids']) or 'All'}\n\n"
+            "Use /campaigns to see all campaigns.",
+            parse_mode='Markdown'
+        )
+        context.user_data.clear()
+        return ConversationHandler.END
+    
+    # Config and buttons are replaced together, so joins never see a half-saved ad
+    await publish_ad_change(save_ad, photo_id, ad_text, buttons)
+    
+    await update.message.reply_text(
         f"✅ *Advertisement Setup Complete!*\n\n"
         f"📸 Photo: {'Yes' if photo_id else 'No'}\n"
         f"📝 Message: Yes\n"
@@ -530,40 +2032,26 @@ async def viewad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
         return
     
-    ad_config = get_ad_config()
+    ad = AD_CACHE
     
-    if not ad_config or not ad_config[1]:  # Check if message_text exists
+    if ad is None:
         await update.message.reply_text(
             "📭 No advertisement configured.\n\n"
             "Use /setad to create one."
         )
         return
     
-    photo_id, message_text = ad_config
-    ad_buttons = get_ad_buttons()
-    
-    # Prepare preview message
-    preview_text = "📺 *Current Advertisement Preview:*\n\n"
-    
-    # Create keyboard if buttons exist
-    reply_markup = None
-    if ad_buttons:
-        keyboard = []
-        for button_text, button_url in ad_buttons:
-            keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-    
     # Send preview
-    if photo_id:
+    if ad.photo_id:
         await update.message.reply_photo(
-            photo=photo_id,
-            caption=message_text,
-            reply_markup=reply_markup
+            photo=ad.photo_id,
+            caption=ad.message_text,
+            reply_markup=ad.reply_markup
         )
     else:
         await update.message.reply_text(
-            message_text,
-            reply_markup=reply_markup
+            ad.message_text,
+            reply_markup=ad.reply_markup
         )
 
 async def clearad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -572,12 +2060,164 @@ async def clearad_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
         return
     
-    clear_ad_config()
+    await publish_ad_change(clear_ad_config)
     await update.message.reply_text(
         "✅ Advertisement cleared!\n\n"
         "Users will receive the default welcome message."
     )
 
+async def campaigns_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """List the ad campaigns"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return
+    
+    campaigns = list(CAMPAIGNS.campaigns.values())
+    if not campaigns:
+        await update.message.reply_text(
+            "📭 No campaigns yet.\n\n"
+            "Use /newcampaign to create one. The /setad ad is shown when no campaign applies."
+        )
+        return
+    
+    reach = dict(await run_db(get_campaign_reach))
+    lines = ["📣 *Campaigns*\n"]
+    for campaign in campaigns:
+        cap = f"{campaign.frequency_cap}x per user ({reach.get(campaign.id, 0)} users reached)" if campaign.frequency_cap else "No cap"
+        chats = ", ".join(f"`{chat_id}`" for chat_id in campaign.chat_ids) or "All chats"
+        lines.append(
+            f"*#{campaign.id}* ⚖️ {campaign.weight} | 🔁 {cap}\n"
+            f"🎯 {chats}\n"
+            f"📝 {escape_markdown(campaign.ad.message_text[:60])}\n"
+        )
+    lines.append("Use `/delcampaign <id>` to remove one.")
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+async def delcampaign_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remove an ad campaign: /delcampaign <id>"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return
+    
+    try:
+        campaign_id = int(context.args[0].lstrip('#'))
+    except (IndexError, ValueError):
+        await update.message.reply_text("❌ Usage: /delcampaign <id> (see /campaigns)")
+        return
+    if campaign_id not in CAMPAIGNS.campaigns:
+        await update.message.reply_text(f"❌ Campaign #{campaign_id} not found.")
+        return
+    
+    await publish_ad_change(delete_campaign, campaign_id)
+    await update.message.reply_text(f"✅ Campaign #{campaign_id} removed!")
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the current ad to everyone who joined: /broadcast [status|stop|resume|cancel]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return
+    
+    action = context.args[0].lower() if context.args else 'start'
+    running = BROADCAST if BROADCAST is not None and BROADCAST.status == 'running' else None
+    
+    if action == 'status':
+        if running:
+            await update.message.reply_text(running.progress_text(), parse_mode='Markdown')
+            return
+        row = await run_db(get_broadcast)
+        if row is None:
+            await update.message.reply_text("📭 No broadcasts yet. Use /broadcast to send the current ad to everyone.")
+            return
+        await update.message.reply_text(Broadcast(row).progress_text(), parse_mode='Markdown')
+    
+    elif action in ('stop', 'cancel'):
+        if running:
+            running.stop('paused' if action == 'stop' else 'cancelled')
+            await update.message.reply_text("⏳ Stopping after the current batch...")
+            return
+        row = await run_db(get_broadcast)
+        if action == 'cancel' and row and row[4] in ('running', 'paused'):
+            await run_db(checkpoint_broadcast, row[0], 'cancelled', row[5], dict(zip(('sent', 'blocked', 'failed'), row[7:10])), [])
+            await update.message.reply_text(f"🛑 Broadcast #{row[0]} cancelled.")
+            return
+        await update.message.reply_text("❌ No broadcast is running.")
+    
+    elif action == 'resume':
+        if running:
+            await update.message.reply_text(f"📣 Broadcast #{running.id} is already running.")
+            return
+        row = await run_db(get_broadcast)
+        if row is None or row[4] not in ('running', 'paused'):
+            await update.message.reply_text("❌ Nothing to resume. Use /broadcast to start a new one.")
+            return
+        start_broadcast(context.bot, row, 'running')
+        await update.message.reply_text(f"▶️ Resuming broadcast #{row[0]}...")
+    
+    elif action == 'start':
+        ad = AD_CACHE
+        if ad is None:
+            await update.message.reply_text("📭 No ad configured. Use /setad first, then /broadcast.")
+            return
+        broadcast_id = await run_db(create_broadcast, ad.photo_id, ad.message_text, ad.buttons or [])
+        if broadcast_id is None:
+            await update.message.reply_text(
+                "⚠️ Another broadcast is not finished yet.\n\n"
+                "Use `/broadcast resume` to continue it or `/broadcast cancel` to drop it.",
+                parse_mode='Markdown'
+            )
+            return
+        start_broadcast(context.bot, await run_db(get_broadcast))
+    
+    else:
+        await update.message.reply_text("❌ Usage: /broadcast [status|stop|resume|cancel]")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Export join or click history: /export [joins|clicks|daily|hourly|clicks-hourly] [from] [to] [chat_id]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return
+    
+    try:
+        kind, since, until, chat_id = parse_export_args(context.args)
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Usage: `/export [joins|clicks|daily|hourly|clicks-hourly] [from] [to] [chat_id]`\n\n"
+            "Dates are YYYY-MM-DD (both included, one date = that day); the chat filter applies to joins, daily and hourly.\n"
+            "`joins`/`clicks` are raw rows from the last `RAW_RETENTION_DAYS`; `daily`/`hourly`/`clicks-hourly` are per-chat "
+            "and per-hour counts that outlive them (updated by each compaction run).\n"
+            "Example: `/export joins 2024-01-01 2024-01-31 -1001234567890`",
+            parse_mode='Markdown'
+        )
+        return
+    if EXPORT_LOCK.locked():
+        await update.message.reply_text("⏳ An export is already running, please wait for it to finish.")
+        return
+    
+    start_background_task(run_export(context.bot, update.effective_chat.id, kind, since, until, chat_id))
+    await update.message.reply_text("📦 Exporting... The files will be sent here as they are ready.")
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Run the sampling profiler: /profile [seconds]"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❓ Unknown command. Use /help to see available commands.")
+        return
+    
+    try:
+        seconds = int(context.args[0]) if context.args else 30
+    except ValueError:
+        await update.message.reply_text(f"❌ Usage: /profile [seconds] (1-{PROFILE_MAX_SECONDS})")
+        return
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        await update.message.reply_text(f"❌ Usage: /profile [seconds] (1-{PROFILE_MAX_SECONDS})")
+        return
+    if PROFILE_LOCK.locked():
+        await update.message.reply_text("⏳ A profile is already running, please wait for its report.")
+        return
+    
+    # Run in the background so updates keep flowing while we sample them
+    start_background_task(run_profile(context.bot, update.effective_chat.id, seconds))
+    await update.message.reply_text(f"🔬 Profiling for {seconds} seconds... The report will be sent as a file.")
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Show bot statistics"""
     if not is_admin(update.effective_user.id):
@@ -585,9 +2225,10 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     # Get stats for different periods
-    stats_7d = get_stats(7)
-    stats_30d = get_stats(30)
-    stats_all = get_stats(36500)  # ~100 years for "all time"
+    stats_7d = await run_db(get_stats, 7)
+    stats_30d = await run_db(get_stats, 30)
+    stats_all = await run_db(get_stats, 36500)  # ~100 years for "all time"
+    outbox_jobs = await run_db(count_outbox_jobs)
     
     # Calculate click rate
     click_rate_7d = (stats_7d['recent_clicks'] / stats_7d['recent_joins'] * 100) if stats_7d['recent_joins'] > 0 else 0
@@ -606,7 +2247,13 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"👥 Total Joins: {stats_all['total_joins']}\n"
         f"🖱️ Total Clicks: {stats_all['total_clicks']}\n"
         f"📈 Click Rate: {click_rate_all:.1f}%\n"
-        f"🏢 Active Groups: {stats_all['unique_groups']}"
+        f"🏢 Active Groups: {stats_all['unique_groups']}\n\n"
+        "*Pipeline:*\n"
+        f"📬 DM Queue: {SEND_QUEUE.depth} in memory, {outbox_jobs} in outbox\n"
+        f"⏱️ Avg DM Latency: {SEND_QUEUE.avg_latency:.2f}s (max {SEND_QUEUE.stats['latency_max']:.2f}s)\n"
+        f"✅ Sent: {SEND_QUEUE.stats['sent']} | 🚫 Blocked: {SEND_QUEUE.stats['forbidden']} | ❌ Failed: {SEND_QUEUE.stats['failed']}\n"
+        f"🔁 Repeat Joiners Skipped: {WELCOME_DEDUP.stats['hits']} ({WELCOME_DEDUP.hit_rate * 100:.1f}% hit rate)\n"
+        f"🗂️ Journal: {JOURNAL.depth} pending"
     )
     
     await update.message.reply_text(stats_text, parse_mode='Markdown')
@@ -623,19 +2270,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return
         
         # Show admin panel
-        keyboard = [
-            [InlineKeyboardButton("📝 Setup Ad", callback_data="setup_ad")],
-            [InlineKeyboardButton("👁️ View Ad", callback_data="view_ad")],
-            [InlineKeyboardButton("🗑️ Clear Ad", callback_data="clear_ad")],
-            [InlineKeyboardButton("📊 Statistics", callback_data="show_stats")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back_to_start")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         await query.edit_message_text(
             "⚙️ *Admin Panel*\n\n"
             "Choose an option:",
-            reply_markup=reply_markup,
+            reply_markup=ADMIN_PANEL_KEYBOARD,
             parse_mode='Markdown'
         )
     
@@ -646,50 +2284,39 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
     
     elif query.data == "view_ad":
-        ad_config = get_ad_config()
+        ad = AD_CACHE
         
-        if not ad_config or not ad_config[1]:
+        if ad is None:
             await query.edit_message_text(
                 "📭 No advertisement configured.\n\n"
                 "Use /setad to create one."
             )
             return
         
-        photo_id, message_text = ad_config
-        ad_buttons = get_ad_buttons()
-        
-        # Create keyboard if buttons exist
-        reply_markup = None
-        if ad_buttons:
-            keyboard = []
-            for button_text, button_url in ad_buttons:
-                keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-            reply_markup = InlineKeyboardMarkup(keyboard)
-        
         # Send preview
-        if photo_id:
+        if ad.photo_id:
             await context.bot.send_photo(
                 chat_id=query.message.chat_id,
-                photo=photo_id,
-                caption=message_text,
-                reply_markup=reply_markup
+                photo=ad.photo_id,
+                caption=ad.message_text,
+                reply_markup=ad.reply_markup
             )
             await query.edit_message_text("📺 Advertisement preview sent above.")
         else:
             await context.bot.send_message(
                 chat_id=query.message.chat_id,
-                text=message_text,
-                reply_markup=reply_markup
+                text=ad.message_text,
+                reply_markup=ad.reply_markup
             )
             await query.edit_message_text("📺 Advertisement preview sent above.")
     
     elif query.data == "clear_ad":
-        clear_ad_config()
+        await publish_ad_change(clear_ad_config)
         await query.edit_message_text("✅ Advertisement cleared!")
     
     elif query.data == "show_stats":
-        stats_7d = get_stats(7)
-        stats_all = get_stats(36500)
+        stats_7d = await run_db(get_stats, 7)
+        stats_all = await run_db(get_stats, 36500)
         
         click_rate_7d = (stats_7d['recent_clicks'] / stats_7d['recent_joins'] * 100) if stats_7d['recent_joins'] > 0 else 0
         click_rate_all = (stats_all['total_clicks'] / stats_all['total_joins'] * 100) if stats_all['total_joins'] > 0 else 0
@@ -710,163 +2337,1494 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await query.edit_message_text(stats_text, parse_mode='Markdown')
     
     elif query.data == "back_to_start":
-        first_name = query.from_user.first_name or "User"
-        message_text = (
-            f"Hello🎈 {first_name}!\n\n"
-            "I Accept Join Requests Automatically\n"
-            "Just ✨ Add Me To Your Channel ➕\n"
-            "Click /start To Know More ⭐⭐"
-        )
-        
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "Add me to your group",
-                    url=f"https://t.me/{BOT_USERNAME}?startgroup=s&admin=invite_users"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "Add me to your channel",
-                    url=f"https://t.me/{BOT_USERNAME}?startchannel=s&admin=invite_users"
-                )
-            ]
-        ]
-        
-        if is_admin(query.from_user.id):
-            keyboard.append([
-                InlineKeyboardButton("⚙️ Admin Panel", callback_data="admin_panel")
-            ])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(message_text, reply_markup=reply_markup)
+        reply_markup = ADMIN_START_KEYBOARD if is_admin(query.from_user.id) else START_KEYBOARD
+        await query.edit_message_text(welcome_text(query.from_user.first_name), reply_markup=reply_markup)
     
     elif query.data.startswith("track_click_"):
         # Track ad click
         user_id = query.from_user.id
         username = query.from_user.username or ""
-        log_click(user_id, username)
+        await JOURNAL.log_click(user_id, username)
         
         # Just answer the callback, URL will open automatically
         await query.answer("Opening link...")
 
+# Rate limiting
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Take one token and return how many seconds to wait before using it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """Rate limiter shared by every Bot API call the bot makes.
+
+    Every request addressed to a chat (approvals included) takes a token from
+    the global bucket; send* requests also take one from the target chat's
+    bucket. A RetryAfter pauses all buckets for the requested time and the
+    request is retried instead of failing.
+    """
+
+    SEND_ENDPOINTS = ('send', 'copyMessage', 'forwardMessage')
+
+    def __init__(self, global_rate, chat_rate, chat_burst, group_per_minute, max_retries):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self._paused_until = 0.0
+        self.stats = {'throttled': 0, 'retry_after': 0}
+
+    async def initialize(self) -> None:
+        """Nothing to set up"""
+
+    async def shutdown(self) -> None:
+        """Nothing to release"""
+
+    def _chat_bucket(self, chat_id):
+        # Forget idle buckets now and then so the dict does not grow forever
+        if len(self._chat_buckets) > 4096:
+            for key, bucket in list(self._chat_buckets.items()):
+                if bucket.is_full():
+                    del self._chat_buckets[key]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.group_rate, 1)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id, is_send):
+        delay = self.global_bucket.reserve()
+        if is_send:
+            delay = max(delay, self._chat_bucket(chat_id).reserve())
+        if delay > 0:
+            self.stats['throttled'] += 1
+            await asyncio.sleep(delay)
+        
+        # A RetryAfter may have paused everything while we were waiting
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        """Wait for tokens, then run the request; RetryAfter pauses and retries"""
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        is_send = endpoint.startswith(self.SEND_ENDPOINTS)
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        
+        for attempt in range(max_retries + 1):
+            await self._acquire(chat_id, is_send)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats['retry_after'] += 1
+                RETRY_AFTER.inc(endpoint)
+                if attempt == max_retries:
+                    raise
+                logger.info(f"Flood limit hit on {endpoint}, pausing for {e.retry_after}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+
+# Outbound message queue
+@storage_function
+def claim_outbox_jobs(owner, limit, now, lease):
+    """Lease up to ``limit`` free DM jobs, highest priority first.
+
+    Returns (id, kind, chat_id, payload JSON, priority, created_at, claims)
+    rows; claims > 1 means an earlier claim never finished.
+    """
+    conn = get_db()
+    with conn:
+        rows = conn.execute('''
+            SELECT id, kind, chat_id, payload, priority, created_at, claims + 1
+            FROM dm_outbox
+            WHERE finished_at IS NULL AND lease_until < ?
+            ORDER BY priority, id
+            LIMIT ?
+        ''', (now, limit)).fetchall()
+        conn.executemany(
+            'UPDATE dm_outbox SET owner = ?, lease_until = ?, claims = claims + 1 WHERE id = ?',
+            [(owner, now + lease, row[0]) for row in rows]
+        )
+    return rows
+
+@storage_function
+def release_outbox_jobs(owner, job_ids=None):
+    """Hand leased DM jobs back to the outbox: the given ids, or all of owner's"""
+    conn = get_db()
+    with conn:
+        if job_ids is None:
+            return conn.execute(
+                'UPDATE dm_outbox SET lease_until = 0 WHERE owner = ? AND lease_until > 0', (owner,)
+            ).rowcount
+        conn.executemany(
+            'UPDATE dm_outbox SET lease_until = 0 WHERE id = ? AND owner = ?',
+            [(job_id, owner) for job_id in job_ids]
+        )
+        return len(job_ids)
+
+@storage_function
+def count_outbox_jobs():
+    """Number of DM jobs that have not finished yet"""
+    conn = get_db()
+    return conn.execute('SELECT COUNT(*) FROM dm_outbox WHERE finished_at IS NULL').fetchone()[0]
+
+class SendQueue:
+    """Prioritized queue of outgoing private messages served by a worker pool.
+
+    Jobs live in the dm_outbox table until they finish. Approvals write them
+    through the journal, in the same transaction as the join, and a reader
+    leases at most ``window`` of them into memory at a time, so a backlog of
+    any size costs no memory and a restart resumes where the last run
+    stopped. Delivery is at-least-once: a job whose lease expires before it
+    finished (crash, deploy) is sent again.
+
+    Each job renders its messages lazily (see ``renderers``) and sends them in
+    order. Transient errors are retried with exponential backoff, resuming at
+    the first unsent message; Forbidden (user blocked the bot) and BadRequest
+    drop the job immediately.
+    """
+
+    def __init__(self, workers, max_attempts, window, lease, poll_interval):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.window = window
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.owner = "main"  # shard workers use their own name, so each resumes its own leases
+        self.renderers = {}
+        self._queue = asyncio.PriorityQueue()
+        self._claimed = set()  # leased job ids that have not finished
+        self._wake = asyncio.Event()
+        self._reader = None
+        self._tasks = []
+        self._retry_tasks = set()
+        self._bot = None
+        self.stats = {
+            'enqueued': 0,
+            'resumed': 0,
+            'sent': 0,
+            'completed': 0,
+            'retried': 0,
+            'forbidden': 0,
+            'failed': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0,
+        }
+
+    @property
+    def depth(self):
+        return self._queue.qsize() + len(self._retry_tasks)
+
+    @property
+    def avg_latency(self):
+        completed = self.stats['completed']
+        return self.stats['latency_total'] / completed if completed else 0.0
+
+    def wake(self):
+        """New jobs were written to the outbox"""
+        self._wake.set()
+
+    def start(self, bot):
+        """Start the worker pool and the outbox reader"""
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._reader = asyncio.create_task(self._read_outbox())
+
+    async def stop(self, timeout):
+        """Give leased jobs up to ``timeout`` seconds to go out, then hand the rest back to the outbox"""
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping send queue with {self.depth} jobs still pending")
+        for task in self._tasks + list(self._retry_tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._retry_tasks, return_exceptions=True)
+        self._tasks = []
+        
+        if self._claimed:
+            try:
+                await run_db(release_outbox_jobs, self.owner, list(self._claimed))
+                logger.info(f"Left {len(self._claimed)} DM jobs in the outbox for the next start")
+            except sqlite3.Error as e:
+                # Their leases expire on their own
+                logger.error(f"Could not release {len(self._claimed)} DM jobs: {e}")
+            self._claimed.clear()
+
+    async def _read_outbox(self):
+        """Keep up to ``window`` outbox jobs leased and queued"""
+        try:
+            resumed = await run_db(release_outbox_jobs, self.owner)
+            pending = await run_db(count_outbox_jobs)
+            if pending:
+                logger.info(f"DM outbox: {pending} jobs pending ({resumed} were in flight when the bot stopped)")
+        except sqlite3.Error as e:
+            logger.error(f"Could not resume the DM outbox: {e}")
+        
+        while True:
+            self._wake.clear()
+            # Top up once half the window has gone out, in one read
+            if len(self._claimed) <= self.window // 2:
+                try:
+                    rows = await run_db(
+                        claim_outbox_jobs, self.owner, self.window - len(self._claimed), time.time(), self.lease
+                    )
+                except sqlite3.Error as e:
+                    logger.error(f"Could not read the DM outbox: {e}")
+                    rows = []
+                for row in rows:
+                    self._load(row)
+                if len(rows) and len(self._claimed) <= self.window // 2:
+                    continue  # a short read; more may have arrived meanwhile
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _load(self, row):
+        job_id, kind, chat_id, payload, priority, created_at, claims = row
+        payload = json.loads(payload)
+        if claims > 1:
+            payload['resumed'] = True
+            self.stats['resumed'] += 1
+        job = {
+            'id': job_id,
+            'kind': kind,
+            'chat_id': chat_id,
+            'payload': payload,
+            'messages': None,
+            'sent': 0,
+            'attempts': 0,
+            'created_at': created_at,
+        }
+        self._claimed.add(job_id)
+        self._queue.put_nowait((priority, job_id, job))
+        self.stats['enqueued'] += 1
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            finished = True
+            try:
+                finished = await self._process(item)
+            except Exception as e:
+                logger.error(f"Unexpected error in send queue worker: {e}")
+            try:
+                if finished:
+                    await self._finish(item[2])
+            except Exception as e:
+                logger.error(f"Could not mark DM job {item[2]['id']} as done: {e}")
+            finally:
+                # Only now, so stop() cannot cancel a worker that is still recording the job
+                self._queue.task_done()
+
+    async def _finish(self, job):
+        """Mark a job that will not be tried again as finished in the outbox"""
+        await JOURNAL.log_dm_done(job['id'])
+        # Still claimed until the journal has it; stop() hands claimed jobs back to the outbox
+        self._claimed.discard(job['id'])
+        if len(self._claimed) <= self.window // 2:
+            self._wake.set()
+
+    async def _process(self, item):
+        """Send a job's messages; returns False when it was scheduled for a retry"""
+        priority, _, job = item
+        job['attempts'] += 1
+        try:
+            if job['messages'] is None:
+                job['messages'] = await self.renderers[job['kind']](job['payload'])
+            while job['sent'] < len(job['messages']):
+                method, kwargs = job['messages'][job['sent']]
+                await getattr(self._bot, method)(chat_id=job['chat_id'], **kwargs)
+                job['sent'] += 1
+                self.stats['sent'] += 1
+                DM_MESSAGES_SENT.inc()
+        except Forbidden:
+            # User blocked the bot or never started it; retrying cannot help
+            self.stats['forbidden'] += 1
+            DM_JOBS.inc('forbidden')
+            return True
+        except BadRequest as e:
+            self.stats['failed'] += 1
+            DM_JOBS.inc('bad_request')
+            logger.warning(f"Dropping {job['kind']} message to {job['chat_id']}: {e}")
+            return True
+        except (RetryAfter, NetworkError) as e:
+            DM_JOBS.inc('retry_after' if isinstance(e, RetryAfter) else 'network_error')
+            if job['attempts'] >= self.max_attempts:
+                self.stats['failed'] += 1
+                DM_JOBS.inc('gave_up')
+                logger.warning(f"Giving up on {job['kind']} message to {job['chat_id']}: {e}")
+                return True
+            delay = e.retry_after if isinstance(e, RetryAfter) else min(2 ** job['attempts'], 60)
+            self.stats['retried'] += 1
+            task = asyncio.create_task(self._retry_later(delay, item))
+            self._retry_tasks.add(task)
+            task.add_done_callback(self._retry_tasks.discard)
+            return False
+        
+        # Measured from the approval, so time spent in the outbox counts too
+        latency = max(0.0, time.time() - job['created_at'])
+        self.stats['completed'] += 1
+        self.stats['latency_total'] += latency
+        self.stats['latency_max'] = max(self.stats['latency_max'], latency)
+        DM_JOBS.inc('completed')
+        DM_SECONDS.observe(latency)
+        return True
+
+    async def _retry_later(self, delay, item):
+        await asyncio.sleep(delay)
+        await self._queue.put(item)
+
+SEND_QUEUE = SendQueue(DM_WORKERS, DM_MAX_ATTEMPTS, DM_QUEUE_SIZE, OUTBOX_LEASE_SECONDS, OUTBOX_POLL_INTERVAL)
+GaugeMetric('bot_dm_queue_depth', "DM jobs waiting or scheduled for retry", lambda: SEND_QUEUE.depth)
+
+# Welcome deduplication
+@storage_function
+def claim_welcome(user_id, now, ttl):
+    """Record a welcome unless one went out within ttl; returns the earlier send time, or None if claimed"""
+    conn = get_db()
+    with conn:
+        claimed = conn.execute('''
+            INSERT INTO welcome_log (user_id, sent_at) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET sent_at = excluded.sent_at
+            WHERE sent_at <= ?
+        ''', (user_id, now, now - ttl)).rowcount
+    if claimed:
+        return None
+    return conn.execute('SELECT sent_at FROM welcome_log WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+class WelcomeDedup:
+    """Remembers who was welcomed recently, so repeat joiners aren't messaged again.
+
+    An LRU of user_id -> expiry bounded to ``max_size`` entries answers most
+    lookups. With ``use_disk`` a memory miss is settled by an atomic claim in
+    welcome_log, which also covers restarts and users whose joins land on
+    different shards.
+    """
+
+    def __init__(self, ttl, max_size, use_disk):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.use_disk = use_disk
+        self._expires = OrderedDict()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    async def seen_recently(self, user_id):
+        """True if this user was welcomed within the window; otherwise record them now"""
+        if not self.ttl:
+            return False
+        now = time.time()
+        expires = self._expires.get(user_id)
+        if expires is not None and expires > now:
+            self._expires.move_to_end(user_id)
+            self.stats['hits'] += 1
+            return True
+        
+        expires = now + self.ttl
+        if self.use_disk:
+            try:
+                sent_at = await run_db(claim_welcome, user_id, int(now), self.ttl)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not check the welcome log for {user_id}: {e}")
+                sent_at = None
+            if sent_at is not None:
+                self._remember(user_id, sent_at + self.ttl)
+                self.stats['hits'] += 1
+                self.stats['disk_hits'] += 1
+                return True
+        self._remember(user_id, expires)
+        self.stats['misses'] += 1
+        return False
+
+    def _remember(self, user_id, expires):
+        self._expires[user_id] = expires
+        self._expires.move_to_end(user_id)
+        if len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+            self.stats['evictions'] += 1
+
+WELCOME_DEDUP = WelcomeDedup(WELCOME_DEDUP_SECONDS, WELCOME_DEDUP_SIZE, WELCOME_DEDUP_DISK)
+GaugeMetric('bot_welcome_dedup_hit_ratio', "Share of welcomes skipped for repeat joiners", lambda: WELCOME_DEDUP.hit_rate)
+
 # Join request handler
+async def render_join_messages(payload):
+    """Build the ad and welcome messages for a newly approved user"""
+    messages = []
+    
+    # Already welcomed after joining another chat: the approval is enough.
+    # A resumed job may have claimed this welcome itself before the restart.
+    if not payload.get('resumed') and await WELCOME_DEDUP.seen_recently(payload.get('user_id')):
+        return messages
+    
+    # FIRST MESSAGE: Send ad if configured (SEPARATE MESSAGE)
+    ad = await pick_ad(payload.get('chat_id'), payload.get('user_id'))
+    if ad is not None:
+        messages.append(tracked_ad_message(ad, payload.get('user_id')))
+    
+    # SECOND MESSAGE: Always send default welcome message (SEPARATE MESSAGE)
+    messages.append(('send_message', {
+        'text': welcome_text(payload['first_name']),
+        'reply_markup': WELCOME_KEYBOARD,
+    }))
+    return messages
+
+SEND_QUEUE.renderers['welcome'] = render_join_messages
+
+async def approve_join_request(chat_join_request, priority=PRIORITY_WELCOME):
+    """Approve a join request, log it and queue the welcome messages"""
+    chat = chat_join_request.chat
+    user = chat_join_request.from_user
+    
+    # Approve the join request
+    started = time.perf_counter()
+    try:
+        await chat_join_request.approve()
+    except Exception:
+        JOIN_APPROVALS.inc('failed')
+        raise
+    APPROVE_SECONDS.observe(time.perf_counter() - started)
+    JOIN_APPROVALS.inc('approved')
+    
+    logger.info(
+        f"Approved join request from {user.first_name} ({user.id}) "
+        f"to {chat.title} ({chat.id})"
+    )
+    
+    # Log the join
+    await JOURNAL.log_join(
+        user_id=user.id,
+        username=user.username or "",
+        first_name=user.first_name or "",
+        chat_id=chat.id,
+        chat_title=chat.title or ""
+    )
+    
+    # Private messages go through the outbox so they never delay the next
+    # approval and survive a restart; a redelivered request has the same key
+    await JOURNAL.log_dm(
+        f"welcome:{chat.id}:{user.id}:{int(chat_join_request.date.timestamp())}",
+        'welcome',
+        user.id,
+        {'first_name': user.first_name or "", 'user_id': user.id, 'chat_id': chat.id},
+        priority
+    )
+
 async def handle_chat_join_request(
     update: Update, 
     context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     """Automatically approve join requests and send custom welcome"""
     try:
-        chat_join_request = update.chat_join_request
-        chat = chat_join_request.chat
-        user = chat_join_request.from_user
-        
-        # Approve the join request
-        await chat_join_request.approve()
+        await approve_join_request(update.chat_join_request)
         
-        logger.info(
-            f"Approved join request from {user.first_name} ({user.id}) "
-            f"to {chat.title} ({chat.id})"
+        # Nothing to persist for a plain joiner; forget the empty user_data PTB created
+        if not context.user_data:
+            context.application.drop_user_data(update.chat_join_request.from_user.id)
+            
+    except Exception as e:
+        logger.error(f"Error approving join request: {e}")
+    
+    # Join requests are fully handled here; skip the remaining handler groups
+    raise ApplicationHandlerStop
+
+
+# Startup backlog
+@storage_function
+def save_backlog_requests(rows):
+    """Store drained join requests as (update_id, JSON) rows"""
+    conn = get_db()
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO backlog_requests (update_id, request) VALUES (?, ?)', rows)
+
+@storage_function
+def get_backlog_requests(after_update_id, limit):
+    """Next stored join requests after the cursor, as (update_id, JSON) rows"""
+    conn = get_db()
+    return conn.execute(
+        'SELECT update_id, request FROM backlog_requests WHERE update_id > ? ORDER BY update_id LIMIT ?',
+        (after_update_id, limit)
+    ).fetchall()
+
+@storage_function
+def delete_backlog_requests(update_ids):
+    """Forget join requests that were handled"""
+    conn = get_db()
+    with conn:
+        conn.executemany('DELETE FROM backlog_requests WHERE update_id = ?', [(update_id,) for update_id in update_ids])
+
+@storage_function
+def count_backlog_requests():
+    """Number of stored join requests not handled yet"""
+    return get_db().execute('SELECT COUNT(*) FROM backlog_requests').fetchone()[0]
+
+async def drain_pending_updates(application: Application):
+    """Fetch every update Telegram queued while the bot was down.
+
+    Join requests are saved to backlog_requests for approve_backlog; anything
+    else goes to the update queue and is handled normally once the bot
+    starts. Fetching past an update confirms it, so each page is saved before
+    the next fetch, and polling or the webhook carries on after them.
+    Returns the number of join requests saved.
+    """
+    bot = application.bot
+    if BOT_MODE == "webhook":
+        # getUpdates is refused while a webhook is set; run_webhook sets it again
+        await bot.delete_webhook(drop_pending_updates=False)
+    
+    allowed_updates = compute_allowed_updates(application)
+    saved = 0
+    offset = 0
+    while True:
+        updates = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=allowed_updates)
+        if not updates:
+            return saved
+        rows = [
+            (update.update_id, json.dumps(update.chat_join_request.to_dict()))
+            for update in updates if update.chat_join_request
+        ]
+        if rows:
+            await run_db(save_backlog_requests, rows)
+            saved += len(rows)
+        for update in updates:
+            if not update.chat_join_request:
+                await application.update_queue.put(update)
+        offset = updates[-1].update_id + 1
+
+async def approve_backlog(bot: Bot):
+    """Approve the stored backlog page by page with a bounded worker pool and report progress to the admin"""
+    total = await run_db(count_backlog_requests)
+    counts = {'approved': 0, 'failed': 0}
+    started = time.monotonic()
+    
+    async def worker(pending):
+        for chat_join_request in pending:
+            try:
+                await approve_join_request(chat_join_request, PRIORITY_BACKLOG)
+                counts['approved'] += 1
+            except TelegramError as e:
+                # Typically the user cancelled the request or an admin already handled it
+                counts['failed'] += 1
+                logger.warning(f"Could not approve backlog join request of {chat_join_request.from_user.id}: {e}")
+    
+    def progress_text():
+        done = counts['approved'] + counts['failed']
+        elapsed = time.monotonic() - started
+        rate = done / elapsed if elapsed else 0.0
+        eta = (total - done) / rate if rate else 0.0
+        return (
+            "⏳ *Approving Pending Join Requests*\n\n"
+            f"✅ Approved: {counts['approved']}/{total}\n"
+            f"❌ Failed: {counts['failed']}\n"
+            f"⚡ Speed: {rate:.1f}/s\n"
+            f"🕐 Remaining: ~{eta / 60:.1f} min"
         )
-        
-        # Log the join
-        log_join(
-            user_id=user.id,
-            username=user.username or "",
-            first_name=user.first_name or "",
-            chat_id=chat.id,
-            chat_title=chat.title or ""
+    
+    async def report(text, message=None):
+        # Progress is best effort; the admin may not have started the bot
+        try:
+            if message is None:
+                return await bot.send_message(ADMIN_ID, text, parse_mode='Markdown')
+            await message.edit_text(text, parse_mode='Markdown')
+        except TelegramError as e:
+            logger.warning(f"Could not report backlog progress: {e}")
+        return message
+    
+    logger.info(f"Approving {total} join requests from the backlog")
+    message = await report(progress_text())
+    reported = time.monotonic()
+    cursor = 0
+    workers = []
+    try:
+        while True:
+            rows = await run_db(get_backlog_requests, cursor, BACKLOG_PAGE_SIZE)
+            if not rows:
+                break
+            pending = iter([ChatJoinRequest.de_json(json.loads(request), bot) for _, request in rows])
+            workers = [asyncio.create_task(worker(pending)) for _ in range(min(BACKLOG_CONCURRENCY, len(rows)))]
+            while not all(task.done() for task in workers):
+                await asyncio.wait(workers, timeout=BACKLOG_PROGRESS_INTERVAL)
+                if time.monotonic() - reported >= BACKLOG_PROGRESS_INTERVAL:
+                    message = await report(progress_text(), message)
+                    reported = time.monotonic()
+            # Only a finished page is forgotten; a restart approves the rest again
+            await run_db(delete_backlog_requests, [update_id for update_id, _ in rows])
+            cursor = rows[-1][0]
+    except asyncio.CancelledError:
+        for task in workers:
+            task.cancel()
+        left = total - counts['approved'] - counts['failed']
+        logger.warning(f"Stopped with {left} backlog join requests still pending; they are approved on the next start")
+        raise
+    
+    elapsed = time.monotonic() - started
+    logger.info(f"Backlog done: {counts['approved']} approved, {counts['failed']} failed in {elapsed:.0f}s")
+    await report(
+        "✅ *Backlog Cleared!*\n\n"
+        f"👥 Approved: {counts['approved']}\n"
+        f"❌ Failed: {counts['failed']}\n"
+        f"🕐 Took: {elapsed / 60:.1f} min",
+        message
+    )
+
+
+# Broadcast
+# /broadcast sends the current ad to the whole audience table. Users are read
+# in user_id order with a keyset cursor, one batch at a time, and progress is
+# checkpointed after every batch, so memory stays flat and a stopped or
+# interrupted broadcast picks up after the last finished batch.
+BROADCAST_TITLES = {
+    'running': "📣 *Broadcasting...*",
+    'paused': "⏸️ *Broadcast Paused*",
+    'cancelled': "🛑 *Broadcast Cancelled*",
+    'done': "✅ *Broadcast Done!*",
+}
+
+@storage_function
+def create_broadcast(photo_file_id, message_text, buttons):
+    """Start a broadcast of an ad; returns its id, or None while another one is unfinished"""
+    conn = get_db()
+    with conn:
+        if conn.execute("SELECT 1 FROM broadcasts WHERE status IN ('running', 'paused')").fetchone():
+            return None
+        total = conn.execute('SELECT COUNT(*) FROM audience WHERE blocked_at IS NULL').fetchone()[0]
+        return conn.execute('''
+            INSERT INTO broadcasts (photo_file_id, message_text, buttons, status, total, started_at)
+            VALUES (?, ?, ?, 'running', ?, ?)
+        ''', (photo_file_id, message_text, json.dumps(buttons), total, utc_timestamp())).lastrowid
+
+@storage_function
+def get_broadcast():
+    """The unfinished broadcast, else the latest one; None if there never was one"""
+    conn = get_db()
+    return conn.execute('''
+        SELECT id, photo_file_id, message_text, buttons, status, cursor, total, sent, blocked, failed
+        FROM broadcasts
+        ORDER BY status IN ('running', 'paused') DESC, id DESC
+        LIMIT 1
+    ''').fetchone()
+
+@storage_function
+def get_audience_page(after_user_id, limit):
+    """Next reachable user ids after the cursor, in order"""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT user_id FROM audience
+        WHERE user_id > ? AND blocked_at IS NULL
+        ORDER BY user_id
+        LIMIT ?
+    ''', (after_user_id, limit)).fetchall()
+    return [row[0] for row in rows]
+
+@storage_function
+def checkpoint_broadcast(broadcast_id, status, cursor, counts, blocked_users):
+    """Save a broadcast's progress and mark the users who blocked the bot, in one transaction"""
+    conn = get_db()
+    now = utc_timestamp()
+    with conn:
+        conn.executemany(
+            'UPDATE audience SET blocked_at = ? WHERE user_id = ?',
+            [(now, user_id) for user_id in blocked_users]
+        )
+        conn.execute('''
+            UPDATE broadcasts
+            SET status = ?, cursor = ?, sent = ?, blocked = ?, failed = ?,
+                finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN ? END
+            WHERE id = ?
+        ''', (status, cursor, counts['sent'], counts['blocked'], counts['failed'], status, now, broadcast_id))
+
+@storage_function
+def mark_user_reachable(user_id):
+    """Include a user in broadcasts again after they started the bot"""
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE audience SET blocked_at = NULL WHERE user_id = ? AND blocked_at IS NOT NULL', (user_id,))
+
+class Broadcast:
+    """One broadcast of an ad to the audience, sent by a rate-limited worker pool.
+
+    At most one batch is sent twice after a crash. Users who turn out to have
+    blocked the bot are marked in the audience and skipped by later
+    broadcasts until they /start the bot again.
+    """
+
+    def __init__(self, row, status=None):
+        self.id, photo_file_id, message_text, buttons, self.status, self.cursor, self.total = row[:7]
+        if status is not None:
+            self.status = status
+        self.ad = build_ad_snapshot((photo_file_id, message_text), [tuple(button) for button in json.loads(buttons)])
+        self.counts = {'sent': row[7], 'blocked': row[8], 'failed': row[9]}
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.stop_status = None  # set by stop(): 'paused' or 'cancelled'
+        self.error = None  # what paused the broadcast, if it was not stop()
+        self.started = time.monotonic()
+        self.resumed_from = self.processed
+
+    @property
+    def processed(self):
+        return sum(self.counts.values())
+
+    def stop(self, status):
+        """Finish the current batch, then stop with the given status"""
+        self.stop_status = status
+
+    def progress_text(self):
+        elapsed = time.monotonic() - self.started
+        rate = (self.processed - self.resumed_from) / elapsed if elapsed else 0.0
+        total = max(self.total, self.processed)  # users who joined meanwhile are included
+        eta = (total - self.processed) / rate if rate else 0.0
+        percent = self.processed / total * 100 if total else 100.0
+        text = (
+            f"{BROADCAST_TITLES[self.status]} #{self.id}\n\n"
+            f"👥 Progress: {self.processed}/{total} ({percent:.1f}%)\n"
+            f"✅ Delivered: {self.counts['sent']}\n"
+            f"🚫 Blocked: {self.counts['blocked']}\n"
+            f"❌ Failed: {self.counts['failed']}\n"
+            f"⚡ Speed: {rate:.1f}/s"
         )
+        if self.status == 'running':
+            text += f"\n🕐 Remaining: ~{eta / 60:.1f} min"
+        if self.error is not None:
+            text += f"\n\n⚠️ Stopped by an error: {escape_markdown(str(self.error))}\nUse /broadcast resume to retry."
+        return text
+
+    async def run(self, bot: Bot):
+        """Send batches until the audience is exhausted or stop() is called"""
+        logger.info(f"Broadcast #{self.id} running from user {self.cursor} ({self.processed}/{self.total} done)")
+        message = None
+        try:
+            await run_db(checkpoint_broadcast, self.id, self.status, self.cursor, self.counts, [])
+            message = await self.report(bot)
+            reported = time.monotonic()
+            while self.stop_status is None:
+                user_ids = await run_db(get_audience_page, self.cursor, BROADCAST_BATCH)
+                if not user_ids:
+                    break
+                blocked_users = await self.send_batch(bot, user_ids)
+                self.cursor = user_ids[-1]
+                await run_db(checkpoint_broadcast, self.id, self.status, self.cursor, self.counts, blocked_users)
+                if time.monotonic() - reported >= BROADCAST_PROGRESS_INTERVAL:
+                    message = await self.report(bot, message)
+                    reported = time.monotonic()
+        except asyncio.CancelledError:
+            # Still 'running' in the database, so the next start resumes it
+            logger.warning(f"Broadcast #{self.id} interrupted after {self.processed}/{self.total} users")
+            raise
+        except Exception as e:
+            # Pause instead of dying as 'running', so stop/resume keep working
+            logger.error(f"Broadcast #{self.id} failed after {self.processed}/{self.total} users: {e}")
+            self.error = e
         
-        # Get ad configuration
-        ad_config = get_ad_config()
+        self.status = 'paused' if self.error is not None else self.stop_status or 'done'
+        try:
+            await run_db(checkpoint_broadcast, self.id, self.status, self.cursor, self.counts, [])
+        except Exception as e:
+            # The last batch checkpoint still holds; at most that batch is sent again
+            logger.error(f"Could not save broadcast #{self.id}: {e}")
+        logger.info(f"Broadcast #{self.id} {self.status}: {self.counts}")
+        await self.report(bot, message)
+
+    async def send_batch(self, bot: Bot, user_ids):
+        """Send to one batch of users with BROADCAST_WORKERS workers; returns the ones who blocked the bot"""
+        pending = iter(user_ids)
+        blocked_users = []
         
-        # Send messages to the user (private message)
+        async def worker():
+            for user_id in pending:
+                result = await self.send(bot, user_id)
+                self.counts[result] += 1
+                BROADCAST_MESSAGES.inc(result)
+                if result == 'blocked':
+                    blocked_users.append(user_id)
+        
+        await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(user_ids)))))
+        return blocked_users
+
+    async def send(self, bot: Bot, user_id):
+        """Send the ad to one user; returns 'sent', 'blocked' or 'failed'"""
+        method, kwargs = tracked_ad_message(self.ad, user_id)
+        for attempt in range(DM_MAX_ATTEMPTS):
+            # Our own pace on top of the global limiter leaves room for welcome DMs
+            delay = self.bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await getattr(bot, method)(chat_id=user_id, **kwargs)
+                return 'sent'
+            except Forbidden:
+                return 'blocked'
+            except BadRequest as e:
+                logger.warning(f"Broadcast #{self.id} could not reach {user_id}: {e}")
+                return 'failed'
+            except (RetryAfter, NetworkError) as e:
+                await asyncio.sleep(e.retry_after if isinstance(e, RetryAfter) else min(2 ** attempt, 60))
+            except TelegramError as e:
+                # e.g. ChatMigrated; nothing a retry would fix
+                logger.warning(f"Broadcast #{self.id} could not reach {user_id}: {e}")
+                return 'failed'
+        return 'failed'
+
+    async def report(self, bot: Bot, message=None):
+        """Send or update the admin's live progress message"""
+        # Progress is best effort; the admin may not have started the bot
         try:
-            first_name = user.first_name or "User"
-            
-            # FIRST MESSAGE: Send ad if configured (SEPARATE MESSAGE)
-            if ad_config and ad_config[1]:
-                photo_id, message_text = ad_config
-                ad_buttons = get_ad_buttons()
-                
-                # Create keyboard for ad buttons only
-                reply_markup = None
-                if ad_buttons:
-                    keyboard = []
-                    for button_text, button_url in ad_buttons:
-                        keyboard.append([InlineKeyboardButton(button_text, url=button_url)])
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Send ad message (with photo or text)
-                if photo_id:
-                    await context.bot.send_photo(
-                        chat_id=user.id,
-                        photo=photo_id,
-                        caption=message_text,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await context.bot.send_message(
-                        chat_id=user.id,
-                        text=message_text,
-                        reply_markup=reply_markup
-                    )
-            
-            # SECOND MESSAGE: Always send default welcome message (SEPARATE MESSAGE)
-            welcome_message = (
-                f"Hello🎈 {first_name}!\n\n"
-                "I Accept Join Requests Automatically\n"
-                "Just ✨ Add Me To Your Channel ➕\n"
-                "Click /start To Know More ⭐⭐"
-            )
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "🔴 Click Here To Start 🔴",
-                        url=f"https://t.me/{BOT_USERNAME}?start=start"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "Add me to your group",
-                        url=f"https://t.me/{BOT_USERNAME}?startgroup=s&admin=invite_users"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "Add me to your channel",
-                        url=f"https://t.me/{BOT_USERNAME}?startchannel=s&admin=invite_users"
-                    )
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await context.bot.send_message(
-                chat_id=user.id,
-                text=welcome_message,
-                reply_markup=reply_markup
+            if message is None:
+                return await bot.send_message(ADMIN_ID, self.progress_text(), parse_mode='Markdown')
+            await message.edit_text(self.progress_text(), parse_mode='Markdown')
+        except TelegramError as e:
+            logger.warning(f"Could not report broadcast progress: {e}")
+        return message
+
+BROADCAST = None  # the Broadcast running in this process
+
+def start_broadcast(bot: Bot, row, status=None):
+    """Run a broadcast from its database row in the background, optionally with a new status"""
+    global BROADCAST
+    BROADCAST = Broadcast(row, status)
+    start_background_task(BROADCAST.run(bot))
+    return BROADCAST
+
+async def resume_broadcast(bot: Bot):
+    """Pick up a broadcast that was running when the bot stopped"""
+    row = await run_db(get_broadcast)
+    if row and row[4] == 'running':
+        start_broadcast(bot, row)
+
+
+# Export
+# /export reads a table in fixed id ranges (EXPORT_CHUNK ids per database
+# call, whatever the filters) and writes gzipped CSV on a worker thread, so
+# memory stays flat, the database thread is never held for long and the
+# event loop keeps approving joins. Files are split at EXPORT_PART_MB to
+# stay under Telegram's upload limit. The rollup kinds page through their
+# primary key instead; they hold the history that compaction has pruned from
+# the raw tables.
+EXPORT_TABLES = {
+    # kind: (table, time column, exported columns)
+    'joins': ('join_stats', 'joined_at', ('id', 'user_id', 'username', 'first_name', 'chat_id', 'chat_title', 'joined_at')),
+    'clicks': ('ad_clicks', 'clicked_at', ('id', 'user_id', 'username', 'clicked_at', 'campaign_id')),
+}
+EXPORT_ROLLUPS = {
+    # kind: (table, time column, primary key, exported columns)
+    'daily': ('join_rollup_daily', 'day', ('day', 'chat_id'), ('day', 'chat_id', 'joins')),
+    'hourly': ('join_rollup_hourly', 'hour', ('hour', 'chat_id'), ('hour', 'chat_id', 'joins')),
+    'clicks-hourly': ('click_rollup_hourly', 'hour', ('hour',), ('hour', 'clicks')),
+}
+EXPORT_LOCK = asyncio.Lock()
+
+def export_columns(kind):
+    """Column names written to the CSV header for an export kind"""
+    if kind in EXPORT_ROLLUPS:
+        return EXPORT_ROLLUPS[kind][3]
+    return EXPORT_TABLES[kind][2]
+
+@storage_function
+def get_export_bounds(kind, since, until):
+    """First and last row id within [since, until), or None if there are no rows"""
+    table, time_column, _ = EXPORT_TABLES[kind]
+    conn = get_db()
+    first = conn.execute(
+        f'SELECT id FROM {table} WHERE {time_column} >= ? ORDER BY {time_column}, id LIMIT 1', (since,)
+    ).fetchone()
+    last = conn.execute(
+        f'SELECT id FROM {table} WHERE {time_column} < ? ORDER BY {time_column} DESC, id DESC LIMIT 1', (until,)
+    ).fetchone()
+    if first is None or last is None or first[0] > last[0]:
+        return None
+    return first[0], last[0]
+
+@storage_function
+def get_export_rows(kind, after_id, last_id, span, since, until, chat_id=None):
+    """Matching rows with after_id < id <= min(after_id + span, last_id)"""
+    table, time_column, columns = EXPORT_TABLES[kind]
+    query = f'''
+        SELECT {', '.join(columns)} FROM {table}
+        WHERE id > ? AND id <= ? AND {time_column} >= ? AND {time_column} < ?
+    '''
+    params = [after_id, min(after_id + span, last_id), since, until]
+    if chat_id is not None:
+        query += ' AND chat_id = ?'
+        params.append(chat_id)
+    return get_db().execute(query + ' ORDER BY id', params).fetchall()
+
+@storage_function
+def get_rollup_rows(kind, after, limit, since, until, chat_id=None):
+    """Up to limit rollup rows within [since, until) whose primary key is past after"""
+    table, time_column, key, columns = EXPORT_ROLLUPS[kind]
+    if time_column == 'day':
+        since, until = since[:10], until[:10]  # days are stored without a time
+    query = f'SELECT {", ".join(columns)} FROM {table} WHERE {time_column} >= ? AND {time_column} < ?'
+    params = [since, until]
+    if after is not None:
+        query += f' AND ({", ".join(key)}) > ({", ".join("?" * len(key))})'
+        params.extend(after)
+    if chat_id is not None:
+        query += ' AND chat_id = ?'
+        params.append(chat_id)
+    query += f' ORDER BY {", ".join(key)} LIMIT ?'
+    params.append(limit)
+    return get_db().execute(query, params).fetchall()
+
+async def iter_export_rows(kind, since, until, chat_id=None):
+    """Yield the matching rows chunk by chunk"""
+    if kind in EXPORT_ROLLUPS:
+        key_size = len(EXPORT_ROLLUPS[kind][2])
+        after = None
+        while True:
+            rows = await run_db(get_rollup_rows, kind, after, EXPORT_CHUNK, since, until, chat_id)
+            if rows:
+                yield rows
+            if len(rows) < EXPORT_CHUNK:
+                return
+            after = list(rows[-1][:key_size])
+    bounds = await run_db(get_export_bounds, kind, since, until)
+    if bounds is None:
+        return
+    cursor, last_id = bounds[0] - 1, bounds[1]
+    while cursor < last_id:
+        rows = await run_db(get_export_rows, kind, cursor, last_id, EXPORT_CHUNK, since, until, chat_id)
+        cursor += EXPORT_CHUNK
+        if rows:
+            yield rows
+
+class ExportPart:
+    """One gzipped CSV file of an export; every method blocks, so call them off the event loop"""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self._file = gzip.open(path, 'wt', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+def parse_export_args(args):
+    """Read [kind] [from] [to] [chat_id] from /export arguments.
+
+    Returns (kind, since, until, chat_id), where since/until bound the
+    timestamps as [since, until); raises ValueError on anything else.
+    """
+    kind, dates, chat_id = 'joins', [], None
+    for arg in args:
+        if arg.lower() in EXPORT_TABLES or arg.lower() in EXPORT_ROLLUPS:
+            kind = arg.lower()
+        elif len(arg) == 10 and arg[4] == '-':
+            dates.append(datetime.strptime(arg, '%Y-%m-%d'))
+        else:
+            chat_id = int(arg)
+    if len(dates) > 2 or (chat_id is not None and 'chat_id' not in export_columns(kind)):
+        raise ValueError(args)
+    since = dates[0].strftime('%Y-%m-%d 00:00:00') if dates else '0000-00-00 00:00:00'
+    until = (dates[-1] + timedelta(days=1)).strftime('%Y-%m-%d 00:00:00') if dates else '9999-12-31 23:59:59'
+    return kind, since, until, chat_id
+
+async def run_export(bot: Bot, send_to, kind, since, until, chat_id=None):
+    """Stream an export into gzipped CSV parts and send each one as a document"""
+    loop = asyncio.get_running_loop()
+    columns = export_columns(kind)
+    
+    async def notify(text, **kwargs):
+        # The admin may have blocked the bot; the export itself is already over
+        try:
+            await bot.send_message(send_to, text, **kwargs)
+        except TelegramError as e:
+            logger.warning(f"Could not report export {label}: {e}")
+    
+    if since[0] == '0':
+        label = f"{kind}-all"
+    else:
+        last_day = datetime.strptime(until[:10], '%Y-%m-%d') - timedelta(days=1)
+        label = f"{kind}-{since[:10]}-{last_day:%Y-%m-%d}"
+    if chat_id is not None:
+        label += f"-{chat_id}"
+    workdir = tempfile.mkdtemp(prefix='export-')
+    part = None
+    parts = rows_total = 0
+    started = time.monotonic()
+    
+    async def send_part():
+        nonlocal part
+        await loop.run_in_executor(None, part.close)
+        with open(part.path, 'rb') as document:
+            await bot.send_document(
+                send_to,
+                document=document,
+                filename=os.path.basename(part.path),
+                caption=f"📦 Part {parts} ({rows_total} rows so far)",
+                write_timeout=EXPORT_UPLOAD_TIMEOUT,
             )
-                
-        except Exception as e:
-            logger.warning(f"Could not send private message to user {user.id}: {e}")
-            
-    except Exception as e:
-        logger.error(f"Error approving join request: {e}")
+        os.remove(part.path)
+        part = None
+    
+    async with EXPORT_LOCK:
+        logger.info(f"Exporting {label}")
+        try:
+            async for rows in iter_export_rows(kind, since, until, chat_id):
+                if part is None:
+                    parts += 1
+                    path = os.path.join(workdir, f"{label}-part{parts}.csv.gz")
+                    part = await loop.run_in_executor(None, ExportPart, path, columns)
+                await loop.run_in_executor(None, part.write, rows)
+                rows_total += len(rows)
+                if part.size >= EXPORT_PART_MB * 1024 * 1024:
+                    await send_part()
+            if part is not None:
+                await send_part()
+        except (sqlite3.Error, TelegramError, OSError) as e:
+            logger.error(f"Export {label} failed: {e}")
+            await notify(f"❌ Export failed after {rows_total} rows: {e}")
+            return
+        finally:
+            if part is not None:
+                await loop.run_in_executor(None, part.close)
+            shutil.rmtree(workdir, ignore_errors=True)
+    
+    elapsed = time.monotonic() - started
+    logger.info(f"Exported {rows_total} rows of {label} in {parts} files ({elapsed:.0f}s)")
+    if not rows_total:
+        await notify("📭 No rows match that export.")
+        return
+    await notify(
+        f"✅ *Export Done!*\n\n"
+        f"📄 Rows: {rows_total}\n"
+        f"🗂️ Files: {parts}\n"
+        f"🕐 Took: {elapsed:.0f}s",
+        parse_mode='Markdown'
+    )
 
 
-def main() -> None:
-    """Start the bot"""
-    # Initialize database
-    init_db()
+# Concurrent update processing
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently with per-chat limits.
+
+    Join requests only share the global limit (plus JOIN_CONCURRENCY_PER_CHAT
+    when set), so approvals across many chats proceed in parallel. Every other
+    update is serialized per chat, which keeps conversations like /setad in
+    order.
+    """
+
+    def __init__(self, max_concurrent_updates, join_per_chat=0):
+        super().__init__(max_concurrent_updates)
+        self.join_per_chat = join_per_chat
+        self._chat_semaphores = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        key, limit = None, 1
+        if isinstance(update, Update):
+            if update.chat_join_request:
+                if self.join_per_chat:
+                    key, limit = ('join', update.chat_join_request.chat.id), self.join_per_chat
+            elif update.effective_chat:
+                key = ('chat', update.effective_chat.id)
+        
+        if key is None:
+            await coroutine
+            return
+        
+        # [semaphore, number of updates using it]; dropped when idle to keep the dict small
+        entry = self._chat_semaphores.get(key)
+        if entry is None:
+            entry = self._chat_semaphores[key] = [asyncio.Semaphore(limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_semaphores[key]
+
+    async def initialize(self) -> None:
+        """Nothing to set up"""
+
+    async def shutdown(self) -> None:
+        """Nothing to release"""
+
+
+BACKGROUND_TASKS = set()
+
+def start_background_task(coroutine):
+    """Run a coroutine in the background until it finishes or the bot stops"""
+    task = asyncio.create_task(coroutine)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+async def stop_background_tasks():
+    """Cancel everything started with start_background_task"""
+    tasks = list(BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+
+
+# Built-in HTTP server (tracked ad links)
+HTTP_SERVER = None
+
+def log_http_request(handler):
+    """Only log server errors; clicks are far too frequent to log one by one"""
+    if handler.get_status() >= 500:
+        logger.warning(f"HTTP {handler.get_status()} for {handler.request.method} {handler.request.path}")
+
+def build_http_app(click_tracking=True):
+    """Routes for the enabled HTTP features, or None when there is nothing to serve"""
+    routes = []
+    if METRICS_ENABLED:
+        routes.append((r'/metrics', MetricsHandler))
+    if CLICK_BASE_URL and click_tracking:
+        routes.append((r'/c/([A-Za-z0-9_=.-]+)', ClickRedirectHandler))
+    if not routes:
+        return None
+    return web.Application(routes, log_function=log_http_request)
+
+def start_http_server(port=HTTP_PORT, click_tracking=True):
+    """Start serving the HTTP routes on HTTP_LISTEN:port"""
+    global HTTP_SERVER
+    http_app = build_http_app(click_tracking)
+    if http_app is None:
+        return
+    HTTP_SERVER = httpserver.HTTPServer(http_app, xheaders=True)
+    HTTP_SERVER.listen(port, HTTP_LISTEN)
+    logger.info(f"HTTP server listening on {HTTP_LISTEN}:{port}")
+
+async def stop_http_server():
+    """Stop accepting requests and close open connections"""
+    global HTTP_SERVER
+    if HTTP_SERVER is None:
+        return
+    HTTP_SERVER.stop()
+    await HTTP_SERVER.close_all_connections()
+    HTTP_SERVER = None
+
+
+async def post_init(application: Application) -> None:
+    """Start background workers once the bot is initialized"""
+    await refresh_ad_cache()
+    JOURNAL.start()
+    SEND_QUEUE.start(application.bot)
+    if application.updater is not None:
+        if BACKLOG_MODE:
+            try:
+                await drain_pending_updates(application)
+            except (TelegramError, sqlite3.Error) as e:
+                # Unsaved updates stay queued at Telegram; polling or the webhook delivers them one by one
+                logger.warning(f"Could not drain pending updates: {e}")
+        # Includes requests left over when a previous run stopped mid-backlog
+        if await run_db(count_backlog_requests):
+            start_background_task(approve_backlog(application.bot))
+    if METRICS_ENABLED:
+        start_background_task(monitor_event_loop())
+    # A broadcast interrupted by a restart continues where the admin's commands are handled
+    if STORE is LOCAL_STORE or SEND_QUEUE.owner == f"shard-{ADMIN_ID % SHARDS}":
+        start_background_task(resume_broadcast(application.bot))
+    if STORE is LOCAL_STORE:
+        # The process that owns the database also serves tracked links
+        start_http_server()
+        start_background_task(compaction_loop())
+    else:
+        # The process that owns the database runs compaction
+        start_background_task(ad_refresh_loop())
+
+
+async def post_stop(application: Application) -> None:
+    """Flush buffered events after update processing has stopped"""
+    await stop_http_server()
+    await stop_background_tasks()
+    await SEND_QUEUE.stop(DM_DRAIN_TIMEOUT)
+    logger.info(f"Send queue stopped: {SEND_QUEUE.stats}")
+    await JOURNAL.stop()
+    logger.info(f"Event journal flushed: {JOURNAL.stats}")
+
+
+async def post_shutdown(application: Application) -> None:
+    """Release the database once the bot has stopped"""
+    logger.info(f"Persistence flushed: {application.persistence.stats}")
+    await STORE.close()
+
+
+# Handler timing
+# build_application wraps every handler callback (including the ones inside
+# the /setad conversation) so each call lands in bot_handler_seconds, and
+# calls slower than SLOW_HANDLER_SECONDS are kept for /profile and logged at
+# most once per SLOW_LOG_INTERVAL.
+SlowCall = namedtuple('SlowCall', 'at handler seconds user_id chat_id')
+SLOW_CALLS = deque(maxlen=SLOW_CALLS_KEPT)
+SLOW_LOG = {'at': float('-inf'), 'suppressed': 0}  # last warning and slow calls not logged since
+
+def timed_handler(callback):
+    """Wrap a handler callback with timing and slow-call tracking"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, name)
+            if elapsed >= SLOW_HANDLER_SECONDS:
+                record_slow_call(name, elapsed, update)
+
+    return wrapper
+
+def record_slow_call(name, elapsed, update):
+    """Keep a slow handler call for the /profile report"""
+    user_id = update.effective_user.id if isinstance(update, Update) and update.effective_user else None
+    chat_id = update.effective_chat.id if isinstance(update, Update) and update.effective_chat else None
+    SLOW_CALLS.append(SlowCall(datetime.now(timezone.utc), name, elapsed, user_id, chat_id))
+    SLOW_HANDLER_CALLS.inc(name)
+    
+    # A join storm makes most calls slow at once; warn once per interval with a count instead
+    now = time.monotonic()
+    if now - SLOW_LOG['at'] < SLOW_LOG_INTERVAL:
+        SLOW_LOG['suppressed'] += 1
+        return
+    more = f"; {SLOW_LOG['suppressed']} more slow calls since the last warning" if SLOW_LOG['suppressed'] else ""
+    logger.warning(f"Slow handler {name}: {elapsed:.2f}s (user {user_id}, chat {chat_id}){more}")
+    SLOW_LOG['at'] = now
+    SLOW_LOG['suppressed'] = 0
+
+def instrument_handlers(application: Application):
+    """Time every registered handler callback"""
+    for handlers in application.handlers.values():
+        for handler in iter_handlers(handlers):
+            handler.callback = timed_handler(handler.callback)
+
+def histogram_quantile(buckets, series, fraction):
+    """Upper bucket bound below which the given fraction of observations fall"""
+    total = sum(series[:-1])
+    cumulative = 0
+    for bound, count in zip(buckets + (float('inf'),), series):
+        cumulative += count
+        if cumulative >= fraction * total:
+            return bound
+    return float('inf')
+
+def handler_timing_lines():
+    """Per-handler call counts and latencies since start"""
+    lines = [f"{'handler':<28} {'calls':>8} {'avg ms':>9} {'p99 ms <=':>10}"]
+    for (name,), series in sorted(HANDLER_SECONDS.series.items(), key=lambda item: -item[1][-1]):
+        calls = sum(series[:-1])
+        p99 = histogram_quantile(HANDLER_SECONDS.buckets, series, 0.99)
+        lines.append(f"{name:<28} {calls:>8} {series[-1] / calls * 1000:>9.1f} {p99 * 1000:>10.0f}")
+    return lines
+
+# Sampling profiler
+# /profile samples the event-loop thread's stack from a helper thread, so it
+# can be switched on in a running worker and costs nothing when it is off.
+PROFILE_LOCK = asyncio.Lock()
+CAPTION_LIMIT = 1024  # Telegram's caption limit, in UTF-16 code units
+PROFILE_WHERE_CHARS = 120  # longest function (file:line) shown in the caption
+
+class SamplingProfiler:
+    """Count which functions the event-loop thread is running"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.idle = 0
+        self.self_time = Counter()   # (file, line, function) where the thread was
+        self.cumulative = Counter()  # (file, first line, function) anywhere on the stack
+
+    def run(self, seconds):
+        """Sample until the time is up; blocks, so run it in a thread"""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.sample(frame)
+            time.sleep(self.interval)
+
+    def sample(self, frame):
+        self.samples += 1
+        code = frame.f_code
+        if code.co_name == 'select' and code.co_filename.endswith('selectors.py'):
+            self.idle += 1  # the loop is waiting for I/O
+            return
+        self.self_time[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if key not in seen:
+                seen.add(key)
+                self.cumulative[key] += 1
+            frame = frame.f_back
+
+    def top(self, counter, limit):
+        """[(share of samples, samples, 'function (file:line)')]"""
+        return [
+            (count / self.samples, count, f"{function} ({os.path.basename(filename)}:{line})")
+            for (filename, line, function), count in counter.most_common(limit)
+        ]
+
+    def report(self, seconds):
+        """Plain-text report of the hot spots, handler timings and slow calls"""
+        busy = 1 - self.idle / self.samples if self.samples else 0
+        lines = [
+            f"Sampling profile of pid {os.getpid()}: {seconds}s, {self.samples} samples every {self.interval * 1000:g}ms",
+            f"Event loop busy: {busy:.1%}",
+            "",
+            "Top self time (where the loop thread was running):",
+        ]
+        lines += [f"{share:>7.1%} {count:>7}  {where}" for share, count, where in self.top(self.self_time, 30)]
+        lines += ["", "Top cumulative time (on the stack):"]
+        lines += [f"{share:>7.1%} {count:>7}  {where}" for share, count, where in self.top(self.cumulative, 30)]
+        lines += ["", "Handler timings since start:"] + handler_timing_lines()
+        lines += ["", f"Slow handler calls (>= {SLOW_HANDLER_SECONDS:g}s, last {SLOW_CALLS_KEPT}):"]
+        lines += [
+            f"{call.at:%Y-%m-%d %H:%M:%S} {call.handler:<28} {call.seconds:>7.2f}s user {call.user_id} chat {call.chat_id}"
+            for call in SLOW_CALLS
+        ] or ["(none)"]
+        return "\n".join(lines) + "\n"
+
+def caption_length(text):
+    """Length of text as Telegram counts it"""
+    return len(text.encode('utf-16-le')) // 2
+
+async def run_profile(bot: Bot, chat_id, seconds):
+    """Profile the event loop for a while and send the report as a file"""
+    async with PROFILE_LOCK:
+        profiler = SamplingProfiler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+        await asyncio.get_running_loop().run_in_executor(None, profiler.run, seconds)
+    
+    busy = 1 - profiler.idle / profiler.samples if profiler.samples else 0
+    header = (
+        f"🔬 *Profile done* ({seconds}s, {profiler.samples} samples)\n"
+        f"⚙️ Event loop busy: {busy:.1%}\n\n"
+    )
+    hot_spots = [
+        f"🔥 {share:.1%} `{where[:PROFILE_WHERE_CHARS]}`" for share, _, where in profiler.top(profiler.self_time, 5)
+    ]
+    # Drop whole lines rather than cutting through a Markdown entity
+    while hot_spots and caption_length(header + "\n".join(hot_spots)) > CAPTION_LIMIT:
+        hot_spots.pop()
+    try:
+        await bot.send_document(
+            chat_id,
+            document=io.BytesIO(profiler.report(seconds).encode()),
+            filename=f"profile-{os.getpid()}-{datetime.now():%Y%m%d-%H%M%S}.txt",
+            caption=header + ("\n".join(hot_spots) or "No samples while busy."),
+            parse_mode='Markdown',
+        )
+    except TelegramError as e:
+        logger.warning(f"Could not send the profile report: {e}")
+
+
+# Update routing
+# Join requests are matched in their own group ahead of everything else and
+# stop dispatch there, so they never walk the command/conversation handlers.
+JOIN_HANDLER_GROUP = -1
+
+HANDLER_UPDATE_TYPES = (
+    (ChatJoinRequestHandler, (Update.CHAT_JOIN_REQUEST,)),
+    (CallbackQueryHandler, (Update.CALLBACK_QUERY,)),
+    (CommandHandler, (Update.MESSAGE,)),
+    (MessageHandler, (Update.MESSAGE,)),
+)
+
+def iter_handlers(handlers):
+    """Yield handlers, expanding the ones nested in conversations"""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from iter_handlers(state_handlers)
+            yield from iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+def compute_allowed_updates(application: Application):
+    """Work out the smallest allowed_updates list that covers every registered handler"""
+    update_types = set()
+    for handlers in application.handlers.values():
+        for handler in iter_handlers(handlers):
+            for handler_class, types in HANDLER_UPDATE_TYPES:
+                if isinstance(handler, handler_class):
+                    update_types.update(types)
+                    break
+            else:
+                # Unknown handler type: don't risk missing its updates
+                return Update.ALL_TYPES
+    return sorted(update_types)
+
+
+def build_application(builder=None) -> Application:
+    """Create the Application and register all handlers"""
+    builder = builder or Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL)
+    builder = builder.post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    builder = builder.persistence(SQLitePersistence(PERSISTENCE_INTERVAL))
+    builder = builder.rate_limiter(
+        TokenBucketRateLimiter(
+            RATE_LIMIT_GLOBAL,
+            RATE_LIMIT_PER_CHAT,
+            RATE_LIMIT_PER_CHAT_BURST,
+            RATE_LIMIT_GROUP_PER_MINUTE,
+            RATE_LIMIT_MAX_RETRIES,
+        )
+    )
+    
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(
+            ChatUpdateProcessor(CONCURRENT_UPDATES, JOIN_CONCURRENCY_PER_CHAT)
+        )
     
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = builder.build()
     
     # Conversation handler for ad setup
     ad_setup_conv = ConversationHandler(
-        entry_points=[CommandHandler('setad', setad_command)],
+        entry_points=[
+            CommandHandler('setad', setad_command),
+            CommandHandler('newcampaign', newcampaign_command),
+        ],
         states={
             WAITING_FOR_PHOTO: [
                 MessageHandler(filters.PHOTO, receive_photo),
@@ -885,6 +3843,8 @@ def main() -> None:
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_setup)],
+        name="ad_setup",
+        persistent=True,
     )
     
     # Register handlers
@@ -892,14 +3852,203 @@ def main() -> None:
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("viewad", viewad_command))
     application.add_handler(CommandHandler("clearad", clearad_command))
+    application.add_handler(CommandHandler("campaigns", campaigns_command))
+    application.add_handler(CommandHandler("delcampaign", delcampaign_command))
     application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(ad_setup_conv)
     application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(ChatJoinRequestHandler(handle_chat_join_request))
+    application.add_handler(ChatJoinRequestHandler(handle_chat_join_request), group=JOIN_HANDLER_GROUP)
+    instrument_handlers(application)
+    
+    return application
+
+
+# Sharded mode
+def shard_for(update: Update, shards: int) -> int:
+    """Pick a worker for an update; a given chat always lands on the same one"""
+    if update.chat_join_request:
+        key = update.chat_join_request.chat.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = 0
+    return key % shards
+
+def run_shard_worker(index, updates) -> None:
+    """Worker process entry point: handle the updates routed to this shard"""
+    # The coordinator handles Ctrl+C and stops workers through their queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(shard_worker(index, updates))
+
+async def shard_worker(index, updates) -> None:
+    """Feed updates from the coordinator into a local Application"""
+    loop = asyncio.get_running_loop()
+    application = build_application(
+        Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL).updater(None)
+    )
+    SEND_QUEUE.owner = f"shard-{index}"
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    # Each shard exposes its own metrics next to the coordinator's port
+    start_http_server(HTTP_PORT + 1 + index, click_tracking=False)
+    logger.info(f"Shard {index} started")
+    try:
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+        logger.info(f"Shard {index} stopped")
+
+async def wait_for_stop_signal() -> None:
+    """Block until SIGINT or SIGTERM arrives"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_coordinator() -> None:
+    """Receive updates, route them to shard workers and serve the shared store"""
+    loop = asyncio.get_running_loop()
+    server = await start_store_server(STORE_LISTEN)
+    
+    context = multiprocessing.get_context('spawn')
+    shard_queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(SHARDS)]
+    workers = [
+        context.Process(target=run_shard_worker, args=(index, shard_queues[index]), name=f"shard-{index}")
+        for index in range(SHARDS)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    allowed_updates = compute_allowed_updates(build_application())
+    update_queue = asyncio.Queue()
+    updater = Updater(Bot(BOT_TOKEN, base_url=BOT_API_URL), update_queue)
+    await updater.initialize()
+    if BOT_MODE == "webhook":
+        await updater.start_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        await updater.start_polling(allowed_updates=allowed_updates)
+    JOURNAL.start()
+    start_http_server()
+    if METRICS_ENABLED:
+        start_background_task(monitor_event_loop())
+    start_background_task(compaction_loop())
+    logger.info(f"Coordinator started with {SHARDS} shards")
+    
+    async def route_updates():
+        while True:
+            update = await update_queue.get()
+            shard_queue = shard_queues[shard_for(update, SHARDS)]
+            data = update.to_dict()
+            try:
+                shard_queue.put_nowait(data)
+            except queue.Full:
+                await loop.run_in_executor(None, shard_queue.put, data)
+            update_queue.task_done()
+    
+    router = asyncio.create_task(route_updates())
+    await wait_for_stop_signal()
+    
+    logger.info("Coordinator stopping...")
+    await updater.stop()
+    await update_queue.join()
+    router.cancel()
+    for shard_queue in shard_queues:
+        await loop.run_in_executor(None, shard_queue.put, None)
+    for worker in workers:
+        await loop.run_in_executor(None, worker.join)
+    await updater.shutdown()
+    await stop_http_server()
+    await stop_background_tasks()
+    await JOURNAL.stop()
+    server.close()
+    await server.wait_closed()
+    await LOCAL_STORE.close()
+
+def run_sharded() -> None:
+    """Start the coordinator and its SHARDS worker processes"""
+    DB_EXECUTOR.submit(init_db).result()
+    
+    # Spawned workers read their configuration from the environment: they use
+    # this process's store and split the global send rate between them
+    os.environ['STORE_URL'] = f"tcp://{STORE_LISTEN}"
+    os.environ['STORE_SECRET'] = STORE_SECRET
+    os.environ['RATE_LIMIT_GLOBAL'] = str(RATE_LIMIT_GLOBAL / SHARDS)
+    asyncio.run(run_coordinator())
+
+async def serve_store() -> None:
+    """Serve the local database to remote workers until stopped"""
+    server = await start_store_server(STORE_LISTEN)
+    JOURNAL.start()
+    start_http_server()
+    start_background_task(compaction_loop())
+    await wait_for_stop_signal()
+    await stop_http_server()
+    await stop_background_tasks()
+    await JOURNAL.stop()
+    server.close()
+    await server.wait_closed()
+    await LOCAL_STORE.close()
+
+def run_store() -> None:
+    """Run only the store server (python telegram_auto_accept_bot.py store)"""
+    DB_EXECUTOR.submit(init_db).result()
+    asyncio.run(serve_store())
+
+
+def main() -> None:
+    """Start the bot"""
+    if len(sys.argv) > 1 and sys.argv[1] == 'store':
+        run_store()
+        return
+    if SHARDS > 1:
+        run_sharded()
+        return
+    
+    # Initialize database on the database thread (a remote store initializes its own)
+    if STORE is LOCAL_STORE:
+        DB_EXECUTOR.submit(init_db).result()
+    
+    application = build_application()
+    allowed_updates = compute_allowed_updates(application)
+    logger.info(f"Requesting update types: {', '.join(allowed_updates)}")
     
     # Start the bot
-    logger.info("Bot is starting...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == "webhook":
+        logger.info(f"Bot is starting in webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        logger.info("Bot is starting...")
+        application.run_polling(allowed_updates=allowed_updates)
 
 
 if __name__ == '__main__':
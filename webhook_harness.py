@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Webhook Test Harness
+Posts synthetic Telegram updates to a locally running bot in webhook mode
+
+Usage:
+    BOT_MODE=webhook WEBHOOK_URL=https://example.com python telegram_auto_accept_bot.py
+    python webhook_harness.py --url http://127.0.0.1:8443/telegram --secret <WEBHOOK_SECRET>
+
+The secret must match the bot's WEBHOOK_SECRET (by default the first 32 hex
+characters of sha256(BOT_TOKEN)). Note that the bot still talks to the Bot API
+for approvals and messages, so point it at a test bot or at the fake Bot API
+server from benchmark.py.
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+
+import httpx
+
+_update_ids = itertools.count(1)
+
+
+def make_user(user_id):
+    """Build a synthetic user"""
+    return {
+        'id': user_id,
+        'is_bot': False,
+        'first_name': f"Test{user_id}",
+        'username': f"test_user_{user_id}",
+    }
+
+
+def make_join_request_update(chat_id, user_id, update_id=None):
+    """Build a chat_join_request update"""
+    return {
+        'update_id': update_id or next(_update_ids),
+        'chat_join_request': {
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': f"Test Chat {chat_id}"},
+            'from': make_user(user_id),
+            'user_chat_id': user_id,
+            'date': int(time.time()),
+        },
+    }
+
+
+def make_command_update(user_id, text, update_id=None):
+    """Build a private message update, e.g. a /start command"""
+    message = {
+        'message_id': next(_update_ids),
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f"Test{user_id}"},
+        'from': make_user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id or next(_update_ids), 'message': message}
+
+
+def make_join_storm(count, chats, first_user_id=1_000_000):
+    """Yield join request updates spread round-robin over N chats"""
+    for i in range(count):
+        yield make_join_request_update(-1_000_000_000_000 - (i % chats), first_user_id + i)
+
+
+async def post_updates(url, secret, updates, concurrency):
+    """POST updates to the webhook and collect status codes and latencies"""
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    latencies = []
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(url, json=update, headers=headers)
+                    status = response.status_code
+                except httpx.HTTPError as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return statuses, latencies
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post synthetic updates to the bot's webhook")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram', help="Webhook URL")
+    parser.add_argument('--secret', required=True, help="WEBHOOK_SECRET of the bot")
+    parser.add_argument('--joins', type=int, default=100, help="Number of join requests to send")
+    parser.add_argument('--chats', type=int, default=10, help="Spread join requests over N chats")
+    parser.add_argument('--start', type=int, default=0, help="Also send N /start commands")
+    parser.add_argument('--concurrency', type=int, default=20, help="Parallel HTTP requests")
+    args = parser.parse_args()
+
+    updates = list(make_join_storm(args.joins, args.chats))
+    updates += [make_command_update(2_000_000 + i, '/start') for i in range(args.start)]
+
+    started = time.perf_counter()
+    statuses, latencies = asyncio.run(post_updates(args.url, args.secret, updates, args.concurrency))
+    elapsed = time.perf_counter() - started
+
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.0f}/s)")
+    print(f"Status codes: {statuses}")
+    print(f"Latency p50: {percentile(latencies, 0.5) * 1000:.1f}ms, p99: {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+
+if __name__ == '__main__':
+    main()